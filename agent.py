@@ -7,9 +7,16 @@ import logging
 import json
 import curses
 import socket
-import emoji
 import numpy as np
 import random
+import time
+import os
+from renderer import Renderer
+from qtable import Sparse_QTable
+from telemetry import Telemetry_Writer
+from compile_policy import load_policy
+from aggregator import Aggregator_Client
+from tracing import Sampled_Tracer, setup_logging
 
 
 __version__ = 'v0.4'
@@ -32,6 +39,9 @@ class q_learning(object):
         self.gamma = confjson.get('gamma', 0.9)
         self.n_episodes_evaluate = confjson.get('n_episodes_evaluate', 1)
         self.eval_every_n_episodes = confjson.get('eval_every_n_episodes', 100)
+        # Random actions are repeated this amount of steps, played by the server in one round trip
+        self.exploration_action_repeat = confjson.get('exploration_action_repeat', 1)
+        self.action_repeat = 1
         self.world = {}
         self.world['size_x'] = theworld.size_x
         self.world['size_y'] = theworld.size_y
@@ -48,6 +58,10 @@ class q_learning(object):
         self.end = theworld.end
         # By default we are not only evaluating a policy
         self.eval_mode = False
+        # Steps and start time of the current episode, for the telemetry
+        self.episode_steps = 0
+        self.episode_start_time = time.time()
+        self.total_episodes = 0
 
         # Where to save the models
         self.behavioral_model_filename = 'behavioral-model'
@@ -56,14 +70,38 @@ class q_learning(object):
 
         # Q-table levels
         # GF stands of Ground Floor. Is the main q_table used when the game starts and it is independent of the 'state' to start
-        self.q_table = {}
+        # Only the visited states of each level use memory. Over the budget, the levels not used recently go to disk
+        memory_budget = confjson.get('q_table_memory_mb', None)
+        self.q_table = Sparse_QTable(self.world['size_x'] * self.world['size_y'],
+                                     len(self.actions),
+                                     block_size=confjson.get('q_table_block_size', 64),
+                                     memory_budget=memory_budget * 1024 * 1024 if memory_budget else None,
+                                     spill_dir=confjson.get('q_table_spill_dir', 'qtable-spill'))
         self.current_qtable_level = 'GF'
+        # Changes of each (state, action) since the last sync with the aggregator, by level, as [delta, visits]
+        # Only the updated ones are kept, like the sparse q_table
+        self.changes = {}
+
+        # Share the q_table with other agents through an aggregator, as host:port
+        self.aggregator = None
+        aggregator_address = confjson.get('aggregator', None)
+        if aggregator_address and not args.replayfile:
+            self.aggregator = Aggregator_Client(aggregator_address, timeout=confjson.get('aggregator_timeout', 10))
+            self.aggregator_sync_every = confjson.get('aggregator_sync_every', 10)
+
+        # One row per episode in a new run directory of the telemetry
+        self.telemetry = None
+        telemetry_dir = confjson.get('telemetry_dir', 'telemetry')
+        if telemetry_dir and not args.replayfile:
+            run_dir = os.path.join(telemetry_dir, time.strftime('run-%Y%m%d-%H%M%S-') + str(os.getpid()))
+            self.telemetry = Telemetry_Writer(run_dir, flush_every=confjson.get('telemetry_flush_every', 100))
 
         # If repaly mode, load the model
         if args.replayfile:
             # Load
-            self.q_table = np.load(args.replayfile, allow_pickle=True)
-            self.q_table = self.q_table.item()
+            saved_q_table = np.load(args.replayfile, allow_pickle=True).item()
+            for level in saved_q_table:
+                self.q_table[level] = saved_q_table[level]
             # Force no random
             self.epsilon_start = 0
             self.epsilon_end = 0
@@ -76,17 +114,15 @@ class q_learning(object):
         """
         Init the q table values for the specified qtable level
         """
-        # The q_table is a dictionary indexed by the 'state' that was used to 'enter' the table, called here the 'level'.
+        # The q_table is indexed by the 'state' that was used to 'enter' the table, called here the 'level'.
         # On each position it has a two dimensional vector of X positions of 'states', and each 'state' has a vector of 4 actions
         # The X positions are in a continous list
         # Example
         #  self.q_table = {'GF': [ [0.1, 0.2, 0.3, 0.4] , ... , [0.1, 0.2, 0.3, 0.4] ], '90': [ [0.1, 0.2, 0.3, 0.4] , ... , [0.1, 0.2, 0.3, 0.4] ]}
-        #self.q_table = np.zeros((self.world['size_x'] * self.world['size_y'], len(self.actions)))
-        try:
-            _ = self.q_table[level] 
-        except KeyError:
-            self.logger.info(f'Creating a new q_table level for level {level}')
-            self.q_table[level] = np.zeros((self.world['size_x'] * self.world['size_y'], len(self.actions)))
+        # The states of a level are only allocated when they are used
+        if level not in self.q_table:
+            self.logger.info('Creating a new q_table level for level %s', level)
+            self.q_table.create_level(level)
 
     def update_world(self, theworld):
         """
@@ -117,6 +153,7 @@ class q_learning(object):
         """
         try:
             #self.logger.info('Choose action.')
+            self.action_repeat = 1
             if not args.replayfile and not self.eval_mode:
                 die = random.random()
                 # How epsilon decays
@@ -124,8 +161,9 @@ class q_learning(object):
                 self.epsilon = (self.epsilon_start - self.epsilon_end ) * decay_rate + self.epsilon_end
                 if die <= self.epsilon:
                     # Random action e-greedy
-                    self.logger.info('Choosing random action.')
+                    tracer.log(self.logger, 'Choosing random action.')
                     action = random.randint(0, len(self.actions) - 1)
+                    self.action_repeat = self.exploration_action_repeat
                 else:
                     # Choose the action that maximizes the value of this state
                     values_actions = self.q_table[self.current_qtable_level][self.current_state]
@@ -134,13 +172,13 @@ class q_learning(object):
                     temp_values_actions = np.array(values_actions)
                     indexes = np.where(temp_values_actions == max_value)[0]
                     action = random.choice(indexes)
-                    self.logger.info(f'Choosing policy action. Action: {self.actions[action]}. Value: {max_value} from {values_actions}')
+                    tracer.log(self.logger, 'Choosing policy action. Action: %s. Value: %s from %s', self.actions[action], max_value, values_actions)
             else:
                 # We are in eval mode or replaying a policy. Do not randomize the selection of actions. No egreedy
                 values_actions = self.q_table[self.current_qtable_level][self.current_state]
                 max_value = np.max(values_actions)
                 action = np.argmax(values_actions)
-                self.logger.info(f'Eval mode: Choosing policy action. Action: {self.actions[action]}. Value: {max_value} from {values_actions}')
+                tracer.log(self.logger, 'Eval mode: Choosing policy action. Action: %s. Value: %s from %s', self.actions[action], max_value, values_actions)
 
             # Store last action
             self.last_action = action
@@ -157,6 +195,7 @@ class q_learning(object):
         """
         # Update world
         self.update_world(world)
+        self.episode_steps += world.action_steps
 
         # If we are replaying or evaluating, don't learn
         if not args.replayfile and not self.eval_mode:
@@ -166,10 +205,12 @@ class q_learning(object):
                 # self.current_state is the state after the transition
                 # self.prev_state is the state before the transition
                 # self.reward is the reward of the transition
+                # After a repeated action, the transition took world.action_steps steps and the reward is their sum,
+                # so the value of the next state is discounted once per step
 
                 # To get the value of Q(s', a')
                 # Select the action that maximices the current policy
-                self.logger.info(f'Learning in level {self.current_qtable_level}')
+                tracer.log(self.logger, 'Learning in level %s', self.current_qtable_level)
                 values_actions = self.q_table[self.current_qtable_level][self.current_state]
                 max_value = np.max(values_actions)
                 # See if the max value appeared many times, and if yes break ties by choosing randomly between those indexes
@@ -178,24 +219,30 @@ class q_learning(object):
                 state_action_idx_max_value = random.choice(indexes)
 
                 # Update Q(s, a)
-                self.logger.info(f'Prev state: {self.prev_state}. Step Reward: {self.reward}. Next state: {self.current_state}. Next StateMaxValue: {self.q_table[self.current_qtable_level][self.current_state][state_action_idx_max_value]}. Idx: {state_action_idx_max_value}')
-                self.logger.info(f'\tBefore update. Action Values: {self.q_table[self.current_qtable_level][self.prev_state]}.')
+                tracer.log(self.logger, 'Prev state: %s. Step Reward: %s. Next state: %s. Next StateMaxValue: %s. Idx: %s', self.prev_state, self.reward, self.current_state, values_actions[state_action_idx_max_value], state_action_idx_max_value)
+                tracer.log(self.logger, '\tBefore update. Action Values: %s.', self.q_table[self.current_qtable_level][self.prev_state])
+                old_value = self.q_table[self.current_qtable_level][self.prev_state][self.last_action]
                 self.q_table[self.current_qtable_level][self.prev_state][self.last_action] = self.q_table[self.current_qtable_level][self.prev_state][self.last_action] + (
                                                 self.learning_rate * (
                                                     self.reward + 
-                                                    (self.gamma * self.q_table[self.current_qtable_level][self.current_state][state_action_idx_max_value]) - 
+                                                    ((self.gamma ** world.action_steps) * self.q_table[self.current_qtable_level][self.current_state][state_action_idx_max_value]) - 
                                                     self.q_table[self.current_qtable_level][self.prev_state][self.last_action] 
                                                     ) 
                                                 )
-                self.logger.info(f'\tAfter  update. Action Values: {self.q_table[self.current_qtable_level][self.prev_state]}.')
+                tracer.log(self.logger, '\tAfter  update. Action Values: %s.', self.q_table[self.current_qtable_level][self.prev_state])
+                if self.aggregator:
+                    change = self.changes.setdefault(self.current_qtable_level, {}).setdefault((self.prev_state, self.last_action), [0, 0])
+                    change[0] += self.q_table[self.current_qtable_level][self.prev_state][self.last_action] - old_value
+                    change[1] += 1
             except Exception as e:
                 self.logger.error(f'Error in learn: {e}')
 
         # Update in which level the agent is playing in the qtable
-        if self.reward > 0:
+        # After a repeated action the reward is a sum, so the level changes with the reward of the last step
+        if world.step_reward > 0:
             # We got some positive reward, so crate/move to the next level
             # If the level exists already, creation is ignored
-            self.logger.info(f'Reward is {self.reward} and >0 so change to level {self.current_state}')
+            self.logger.info('Reward is %s and >0 so change to level %s', world.step_reward, self.current_state)
             self.initialize_q_table(level=self.current_state)
             self.current_qtable_level = self.current_state
 
@@ -204,21 +251,38 @@ class q_learning(object):
         """
         End of episode
         """
+        if self.telemetry:
+            now = time.time()
+            self.total_episodes += 1
+            self.telemetry.append(episode=self.total_episodes,
+                                  score=self.score,
+                                  steps=self.episode_steps,
+                                  epsilon=0 if self.eval_mode else self.epsilon,
+                                  levels=len(self.q_table),
+                                  wall_time=now,
+                                  steps_per_sec=self.episode_steps / max(now - self.episode_start_time, 1e-9),
+                                  eval=self.eval_mode)
+            self.episode_steps = 0
+            self.episode_start_time = now
+
         if not args.replayfile and not self.eval_mode:
             # We are in training mode
 
             self.last_episode_scores.append(self.score)
-            self.logger.info(f'Episode ended. Score: {self.score}')
+            self.logger.info('Episode ended. Score: %s', self.score)
             self.episodes += 1
 
+            if self.aggregator and self.episodes % self.aggregator_sync_every == 0:
+                self.sync_q_table()
+
             if self.episodes % self.eval_every_n_episodes == 0:
                 avg_scores = np.average(self.last_episode_scores)
                 self.logger.critical(f'Summary of episodes elapsed: {self.episodes}. Avg Scores in last {self.eval_every_n_episodes} episodes: {avg_scores:.4f}. Epsilon: {self.epsilon:.5f}. Saving.')
+                # The models are saved as a dict of dense levels, one level at a time
                 # Save txt
-                with open(self.target_model_filename + '.txt', 'w+') as fi:
-                    fi.write(str(self.q_table))
+                self.q_table.save_txt(self.target_model_filename + '.txt')
                 # Save npy
-                np.save(self.target_model_filename, self.q_table)
+                self.q_table.save(self.target_model_filename)
                 # Delete the previous scores so the avg is of the last X
                 self.last_episode_scores = []
 
@@ -238,11 +302,11 @@ class q_learning(object):
 
                 avg_scores = np.average(self.last_eval_episode_scores)
                 self.logger.critical(f'Eval episodes elapsed: {self.eval_episodes}. Avg Scores in last {self.n_episodes_evaluate} episodes: {avg_scores:.4f}. Saving.')
+                # The models are saved as a dict of dense levels, one level at a time
                 # Save txt
-                with open(self.eval_model_filename + '.txt', 'w+') as fi:
-                    fi.write(str(self.q_table))
+                self.q_table.save_txt(self.eval_model_filename + '.txt')
                 # Save npy
-                np.save(self.eval_model_filename, self.q_table)
+                self.q_table.save(self.eval_model_filename)
 
                 # Finished the evalution after some episodes
                 self.eval_mode = False
@@ -258,6 +322,60 @@ class q_learning(object):
         self.score = 0
 
 
+    def sync_q_table(self):
+        """
+        Send the changes of the q_table to the aggregator and continue with the merged q_table
+        """
+        try:
+            merged = self.aggregator.sync(self.q_table.n_states, self.q_table.n_actions, self.changes)
+        except OSError as e:
+            # Keep learning alone, the changes are sent in the next sync
+            self.logger.error(f'Error syncing with the aggregator: {e}')
+            return
+        self.changes = {}
+        # Only the merged levels that changed are received, and they are replaced one at a time
+        for level, values in merged:
+            self.q_table[level] = values
+
+
+class compiled_policy(object):
+    """
+    Plays a greedy policy compiled with compile_policy.py
+
+    It has the same API as q_learning, but it does not learn or explore.
+    Choosing an action is one lookup in the array of the current level.
+    """
+    def __init__(self, theworld):
+        self.actions = ['KEY_UP', 'KEY_DOWN', 'KEY_LEFT', 'KEY_RIGHT']
+        self.logger = logging.getLogger('policy')
+        self.policy = load_policy(args.replayfile)
+        self.action_repeat = 1
+        self.current_level = self.policy.ground_floor
+        self.current_state = theworld.current_state
+
+    def act(self, world):
+        """
+        Receive a world
+        Return an action
+        """
+        return self.actions[self.policy.actions[self.current_level, self.current_state]]
+
+    def learn(self, world):
+        """
+        Move to the next state, and to the next level after a positive reward
+        """
+        self.current_state = world.current_state
+        if world.step_reward > 0:
+            self.current_level = self.policy.level_index[self.current_state]
+
+    def game_ended(self):
+        """
+        End of episode
+        """
+        # Reset to first level
+        self.current_level = self.policy.ground_floor
+
+
 class Game(object):
     """
     Game object
@@ -271,6 +389,11 @@ class Game(object):
         self.end = False
         self.current_state = -1
         self.current_reward = 0
+        # Steps played by the server for the last action, and the reward of the last of them
+        self.action_steps = 1
+        self.step_reward = 0
+        # First world of the next game, if the server sent it with the last one
+        self.reset = None
 
 def start_agent(w, sock):
     """
@@ -284,17 +407,39 @@ def start_agent(w, sock):
 
         myworld = Game()
 
+        # Draws the worlds in the window
+        renderer = Renderer(w, max_fps=args.fps)
+
+        # The worlds from the server are separated by new lines
+        sock_file = sock.makefile('rb')
+
         # Get data from server
-        net_data = sock.recv(2048)
-        logger.info(f'Received: {net_data.decode()!r}')
+        net_data = sock_file.readline()
+        logger.info('Received: %r', net_data)
+
+        if args.world:
+            # The server starts in its first world, move to the chosen one
+            sock.send(f'WORLD {args.world}'.encode())
+            net_data = sock_file.readline()
+            logger.info('Received: %r', net_data)
+            if not net_data or net_data.startswith(b'{"error"'):
+                logger.error(f'The server can not play the world {args.world}: {net_data!r}')
+                return
 
         # Process data, print world
-        process_data(myworld, net_data, w)
+        process_data(myworld, net_data, renderer)
 
         # Here we load the model we want
-        agent_model = q_learning(myworld)
+        if args.replayfile and args.replayfile.endswith('.npz'):
+            # A compiled policy, no need to load the q_table
+            agent_model = compiled_policy(myworld)
+        else:
+            agent_model = q_learning(myworld)
 
         while True:
+            # Only the sampled steps are logged, the rest do not format anything
+            tracer.step()
+
             # Check end
             if check_end(myworld):
                 # The game ended
@@ -302,40 +447,48 @@ def start_agent(w, sock):
                 # If in test mode, stop here
                 if args.replayfile:
                     return True
-                # Get the new map to reset
-                net_data = sock.recv(2048)
-                logger.info(f'Received: {net_data.decode()!r}')
-                # Process data, print world
-                # The world is resseted by the server, here we just load it
-                process_data(myworld, net_data, w)
+                if myworld.reset is not None:
+                    # The server sent the new map with the last one
+                    process_world(myworld, myworld.reset, renderer)
+                else:
+                    # Get the new map to reset
+                    net_data = sock_file.readline()
+                    tracer.log(logger, 'Received: %r', net_data)
+                    # Process data, print world
+                    # The world is resseted by the server, here we just load it
+                    process_data(myworld, net_data, renderer)
 
             # Get key from agent, the action
             key = agent_model.act(myworld)
 
             # Print the action
-            print_action(key, myworld, w)
+            print_action(key, myworld, renderer)
 
             if "KEY_UP" in key:
-                sock.send(b'UP')
+                message = b'UP'
             elif "KEY_DOWN" in key:
-                sock.send(b'DOWN')
+                message = b'DOWN'
             elif "KEY_RIGHT" in key:
-                sock.send(b'RIGHT')
+                message = b'RIGHT'
             elif "KEY_LEFT" in key:
-                sock.send(b'LEFT')
+                message = b'LEFT'
             elif "q" in key:
                 break
             else:
                 key = ''
-                sock.send(b' ')
-            logger.info(f'Sending: {key!r}')
+                message = b' '
+            # A repeated action is sent as KEY*N, and the server plays all the steps
+            if agent_model.action_repeat > 1:
+                message += f'*{agent_model.action_repeat}'.encode()
+            sock.send(message)
+            tracer.log(logger, 'Sending: %r', key)
 
             # Get data from server
-            net_data = sock.recv(2048)
-            logger.info(f'Received: {net_data.decode()!r}')
+            net_data = sock_file.readline()
+            tracer.log(logger, 'Received: %r', net_data)
 
             # Process data, print world
-            process_data(myworld, net_data, w)
+            process_data(myworld, net_data, renderer)
 
             # With this new data, now learn
             agent_model.learn(myworld)
@@ -356,41 +509,49 @@ def check_end(myworld):
         myworld.world_score = 0
         return True
 
-def process_data(myworld, data, w):
+def process_data(myworld, data, renderer):
     """
     Process the data sent by the server
     """
     try:
         # convert to dict
-        data = json.loads(data)
+        process_world(myworld, json.loads(data), renderer)
+    except Exception as e:
+        logging.error(f'Error in process_data: {e}')
+
+def process_world(myworld, data, renderer):
+    """
+    Process a world sent by the server, already converted to a dict
+    """
+    try:
         myworld.size_x = int(data['size'].split('x')[0])
         myworld.size_y = int(data['size'].split('x')[1])
         myworld.current_reward = data['reward']
         myworld.world_score += myworld.current_reward
         myworld.world_positions = data['positions']
         myworld.current_state = data['current_character_position']
+        myworld.action_steps = data.get('action_steps', 1)
+        myworld.step_reward = data.get('step_reward', myworld.current_reward)
         myworld.end = data['end']
+        myworld.reset = data.get('reset', None)
         # Print positions
-        minimum_y = 10
         # In the console graph Y grows going down and X grows to the right
-        for x in range(myworld.size_x):
-            for y in range(myworld.size_y):
-                w.addstr(y + minimum_y, x, emoji.emojize(str(myworld.world_positions[x + (y * 10)])))
+        renderer.set_world(myworld.world_positions, myworld.size_x)
         # Print score
-        w.addstr(minimum_y + myworld.size_y + 1, 0, f"Reward: {str(myworld.current_reward):>5}")
-        w.addstr(minimum_y + myworld.size_y + 2, 0, f"Score: {str(myworld.world_score):>5}")
+        renderer.set_text(1, f"Reward: {str(myworld.current_reward):>5}")
+        renderer.set_text(2, f"Score: {str(myworld.world_score):>5}")
 
 
     except Exception as e:
-        logging.error(f'Error in process_data: {e}')
+        logging.error(f'Error in process_world: {e}')
 
-def print_action(action, myworld, w):
+def print_action(action, myworld, renderer):
     """
     Print the action from the agent
+    The window is only refreshed if the last frame was long enough ago
     """
-    minimum_y = 10
-    w.addstr(myworld.size_y + minimum_y + 3, 0, f'{action:<15}')
-    w.refresh()
+    renderer.set_text(3, f'{action:<15}')
+    renderer.refresh()
 
 
 def main(w):
@@ -414,8 +575,13 @@ def main(w):
     server = args.server
     port = args.port
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((server, port))
+    if args.unix:
+        # Same host as the server, skip the TCP stack
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.unix)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((server, port))
 
     # Start the agent
     start_agent(w, sock)
@@ -432,15 +598,22 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--debug', help='Amount of debugging. This shows inner information about the flows. INFO, DEBUG, ERROR, CRITICAL', action='store', required=False, type=str)
     parser.add_argument('-s', '--server', help='IP of game server.', action='store', required=False, type=str, default='127.0.0.1')
     parser.add_argument('-p', '--port', help='Port of game server.', action='store', required=False, type=int, default=9000)
+    parser.add_argument('-u', '--unix', help='Path of the unix socket of the game server. Used instead of the IP and port when the server is in the same host.', action='store', required=False, type=str)
     parser.add_argument('-c', '--configfile', help='Configuration file.', action='store', required=True, type=str)
-    parser.add_argument('-r', '--replayfile', help='Used this saved model strategy to play in human time.', action='store', required=False, type=str)
+    parser.add_argument('-r', '--replayfile', help='Used this saved model strategy to play in human time. It can be a model (.npy) or a policy compiled with compile_policy.py (.npz).', action='store', required=False, type=str)
+    parser.add_argument('-f', '--fps', help='Max frames per second to draw. 0 draws every step.', action='store', required=False, type=float, default=0)
+    parser.add_argument('-W', '--world', help='Name of the world to play, in servers with many worlds. Without it, the first world of the server.', action='store', required=False, type=str)
 
     args = parser.parse_args()
-    logging.basicConfig(filename='agent.log', filemode='a', format='%(asctime)s %(name)s %(levelname)s %(message)s', datefmt='%H:%M:%S',level=logging.CRITICAL)
+    # The file is written by a thread, so logging does not block the steps
+    setup_logging('agent.log', level=getattr(logging, args.debug.upper(), logging.CRITICAL) if args.debug else logging.CRITICAL, format='%(asctime)s %(name)s %(levelname)s %(message)s')
 
     with open(args.configfile, 'r') as jfile:
         confjson = json.load(jfile)
 
+    # Log 1 in every trace_steps steps. 0 logs none
+    tracer = Sampled_Tracer(confjson.get('trace_steps', 1))
+
     try:
         curses.wrapper(main)
     except Exception as e:
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# Q-table aggregator for the distributed agents of the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import argparse
+import asyncio
+import io
+import logging
+import os
+import socket
+import struct
+import numpy as np
+
+__version__ = 'v0.1'
+
+# Each message is its length in 8 bytes followed by a npz file
+header = struct.Struct('>Q')
+
+
+def level_name(level):
+    """
+    Get the level of a q_table from its name in a npz file
+    """
+    return level if level == 'GF' else int(level)
+
+
+def encode_message(arrays):
+    """
+    Convert a dict of arrays to the bytes of a message, without pickle
+    The arrays are compressed, the levels of a q_table are mostly zeros
+    """
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    data = buffer.getvalue()
+    return header.pack(len(data)) + data
+
+
+def decode_message(data):
+    """
+    Convert the npz bytes of a message to a dict of arrays
+    """
+    with np.load(io.BytesIO(data)) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def decode_levels(data):
+    """
+    Get the merged levels of a message one at a time, as (level, values)
+    """
+    with np.load(io.BytesIO(data)) as npz:
+        for name in npz.files:
+            yield level_name(name[2:]), npz[name]
+
+
+class QTable_Aggregator(object):
+    """
+    Class QTable_Aggregator
+    The merged q_table of all the workers
+
+    The workers send the change of each state and action they updated since
+    their last sync, and how many times they updated it. The q_table of each
+    worker is its previous q_table plus these changes. It is never replaced
+    by the merged q_table, so the values of the other workers are not merged
+    in again, and a sync without changes does not change the merged q_table.
+    The first q_table of a worker in a level is the merged level it got in
+    its last sync, or zeros. The workers get back the merged levels that
+    changed since their last sync.
+
+    With 'average' the merged q_table is the average of the q_tables of the
+    workers. With 'visits' each state and action is the average weighted by
+    how many times each worker updated it.
+    """
+    def __init__(self, merge='visits', output='merged-model', save_every=10):
+        self.merge = merge
+        # Where and every how many merges the merged q_table is saved
+        self.output = output
+        self.save_every = save_every
+        self.q_table = {}
+        # The q_table and the visits of each worker, by level
+        self.tables = {}
+        self.visits = {}
+        # The merged levels sent to each worker
+        self.sent = {}
+        self.merges = 0
+        self.logger = logging.getLogger('AGGREGATOR')
+
+    def merge_changes(self, worker, shape, changes):
+        """
+        Merge the changes of a worker. By level, they are the arrays of the
+        states, actions, deltas and visits of the states and actions updated
+        Returns the merged levels that changed since the last sync of the worker
+        """
+        tables = self.tables.setdefault(worker, {})
+        worker_visits = self.visits.setdefault(worker, {})
+        sent = self.sent.setdefault(worker, {})
+        for level, (states, actions, deltas, visits) in changes.items():
+            if level not in tables:
+                tables[level] = sent[level].copy() if level in sent else np.zeros(shape)
+                worker_visits[level] = np.zeros(shape, dtype=np.int64)
+            # The same state and action is only once in a message, but add.at does not depend on it
+            np.add.at(tables[level], (states, actions), deltas)
+            np.add.at(worker_visits[level], (states, actions), visits)
+            # The tables and visits of all the workers that have this level
+            level_tables = np.array([self.tables[other][level] for other in self.tables if level in self.tables[other]])
+            average = level_tables.mean(axis=0)
+            if self.merge == 'average':
+                self.q_table[level] = average
+            else:
+                level_visits = np.array([self.visits[other][level] for other in self.tables if level in self.tables[other]])
+                total_visits = level_visits.sum(axis=0)
+                weighted = (level_tables * level_visits).sum(axis=0) / np.maximum(total_visits, 1)
+                # The states and actions that no worker updated keep the average
+                self.q_table[level] = np.where(total_visits > 0, weighted, average)
+        self.merges += 1
+        # The merged levels are replaced, never changed, so the ones already sent are the same objects
+        changed = {level: values for level, values in self.q_table.items() if sent.get(level) is not values}
+        sent.update(changed)
+        self.logger.info('Merged %s levels from worker %s. Merges: %s. Workers: %s', len(changes), worker, self.merges, len(self.tables))
+        return changed
+
+    def save(self):
+        """
+        Save the merged q_table like the agent saves its models
+        """
+        np.save(self.output, dict(self.q_table))
+
+    async def handle_worker(self, reader, writer):
+        """
+        Function to deal with each worker
+        A worker sends its changes and receives the merged levels, as many times as it wants
+        """
+        addr = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    length, = header.unpack(await reader.readexactly(header.size))
+                except asyncio.IncompleteReadError:
+                    self.logger.info('Worker %s disconnected', addr)
+                    break
+                message = decode_message(await reader.readexactly(length))
+                worker = str(message.pop('worker'))
+                shape = tuple(int(size) for size in message.pop('shape'))
+                changes = {}
+                for name in message:
+                    if name.startswith('states-'):
+                        level = name[7:]
+                        changes[level_name(level)] = (message[name], message[f'actions-{level}'], message[f'deltas-{level}'], message[f'visits-{level}'])
+                merged = self.merge_changes(worker, shape, changes)
+                if self.save_every and self.merges % self.save_every == 0:
+                    self.save()
+                writer.write(encode_message({f'q-{level}': values for level, values in merged.items()}))
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError, IndexError) as e:
+            self.logger.error(f'Error with worker {addr}: {e}')
+        finally:
+            writer.close()
+
+
+class Aggregator_Client(object):
+    """
+    Class Aggregator_Client
+    Syncs the q_table of an agent with the aggregator
+
+    Only the states and actions that the agent updated since the last sync
+    are sent, and only the merged levels that changed are received, so the
+    q_table is never dense in memory. A sync that takes more than timeout
+    seconds fails, so the agent is never blocked by the aggregator.
+    """
+    def __init__(self, address, worker=None, timeout=10):
+        host, _, port = address.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self.worker = worker or f'{socket.gethostname()}-{os.getpid()}'
+        self.timeout = timeout
+        self.sock = None
+        self.logger = logging.getLogger('aggregator')
+
+    def sync(self, n_states, n_actions, changes):
+        """
+        Send the changes of the q_table since the last sync. By level, they
+        are dicts of [delta, visits] by (state, action)
+        Returns the merged levels that changed, as (level, values) one at a time
+        """
+        arrays = {'worker': np.array(self.worker), 'shape': np.array([n_states, n_actions])}
+        for level, level_changes in changes.items():
+            keys = np.array(list(level_changes), dtype=np.int64).reshape(-1, 2)
+            values = np.array(list(level_changes.values()), dtype=np.float64).reshape(-1, 2)
+            arrays[f'states-{level}'] = keys[:, 0]
+            arrays[f'actions-{level}'] = keys[:, 1]
+            arrays[f'deltas-{level}'] = values[:, 0]
+            arrays[f'visits-{level}'] = values[:, 1].astype(np.int64)
+        if self.sock is None:
+            # The timeout is also used by every send and receive of the socket
+            self.sock = socket.create_connection(self.address, timeout=self.timeout)
+        try:
+            self.sock.sendall(encode_message(arrays))
+            length, = header.unpack(self.receive(header.size))
+            data = self.receive(length)
+        except OSError:
+            # Also a timeout. Connect again in the next sync, the reply of this one is not waited for
+            self.sock.close()
+            self.sock = None
+            raise
+        self.logger.info('Synced %s levels with the aggregator', len(changes))
+        return decode_levels(data)
+
+    def receive(self, length):
+        """
+        Receive exactly length bytes
+        """
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.sock.recv(length - len(data))
+            if not chunk:
+                raise ConnectionError('Aggregator closed the connection')
+            data += chunk
+        return bytes(data)
+
+
+async def aggregator(host, port, qtable_aggregator):
+    """
+    Start the aggregator server
+    """
+    logger = logging.getLogger('AGGREGATOR')
+    server = await asyncio.start_server(qtable_aggregator.handle_worker, host, port)
+    addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+    logger.info(f'Serving on {addrs}')
+    await server.serve_forever()
+
+
+# Main
+####################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Hacker Grid World q_table aggregator version {__version__}. Author: Sebastian Garcia, eldraco@gmail.com", usage='%(prog)s [options]')
+    parser.add_argument('-s', '--server', help='IP to listen for workers.', action='store', required=False, type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port to listen for workers.', action='store', required=False, type=int, default=9500)
+    parser.add_argument('-m', '--merge', help='How to merge the changes of the workers: average or visits.', action='store', required=False, type=str, choices=['average', 'visits'], default='visits')
+    parser.add_argument('-o', '--output', help='File to save the merged q_table, like the models of the agent.', action='store', required=False, type=str, default='merged-model')
+    parser.add_argument('-e', '--save_every', help='Save the merged q_table every this amount of merges. 0 only saves when the aggregator stops.', action='store', required=False, type=int, default=10)
+
+    args = parser.parse_args()
+    logging.basicConfig(filename='aggregator.log', filemode='a', format='%(asctime)s, %(name)s: %(message)s', datefmt='%H:%M:%S', level=logging.CRITICAL)
+
+    qtable_aggregator = QTable_Aggregator(args.merge, args.output, args.save_every)
+    try:
+        asyncio.run(aggregator(args.server, args.port, qtable_aggregator))
+    except KeyboardInterrupt:
+        logging.debug('Terminating by KeyboardInterrupt')
+    finally:
+        if qtable_aggregator.q_table:
+            qtable_aggregator.save()
@@ -7,7 +7,7 @@ import logging
 import json
 import curses
 import socket
-import emoji
+from renderer import Renderer
 
 
 __version__ = 'v0.1'
@@ -19,6 +19,8 @@ class Game():
     def __init__(self):
         self.end = False
         self.world_score = 0
+        # First world of the next game, if the server sent it with the last one
+        self.reset = None
 
 def start_client(w, sock):
     """
@@ -31,27 +33,45 @@ def start_client(w, sock):
 
         myworld = Game()
 
+        # Draws the worlds in the window
+        renderer = Renderer(w)
+
+        # The worlds from the server are separated by new lines
+        sock_file = sock.makefile('rb')
+
+        if args.world:
+            # The server starts in its first world, move to the chosen one
+            sock_file.readline()
+            sock.send(f'WORLD {args.world}'.encode())
+
         stop_signal = False
         while not stop_signal:
             # Get data
-            net_data = sock.recv(2048)
+            net_data = sock_file.readline()
             logger.info(f'Received: {net_data.decode()!r}')
+            if not net_data or net_data.startswith(b'{"error"'):
+                logger.error(f'The server closed the session: {net_data.decode()!r}')
+                break
 
             # Process data, print world
-            process_data(myworld, net_data, w)
+            process_data(myworld, net_data, renderer)
 
             # Check end
             if check_end(myworld):
                 # The game ended
-                # Get the new map to reset
-                net_data = sock.recv(2048)
-                logger.info(f'Received: {net_data.decode()!r}')
-                # Process data, print world
-                process_data(myworld, net_data, w)
+                if myworld.reset is not None:
+                    # The server sent the new map with the last one
+                    process_world(myworld, myworld.reset, renderer)
+                else:
+                    # Get the new map to reset
+                    net_data = sock_file.readline()
+                    logger.info(f'Received: {net_data.decode()!r}')
+                    # Process data, print world
+                    process_data(myworld, net_data, renderer)
 
             # Get key from user and process it
             while True:
-                key = get_key(myworld, w)
+                key = get_key(myworld, w, renderer)
 
                 if "KEY_UP" in key:
                     sock.send(b'UP')
@@ -76,6 +96,38 @@ def start_client(w, sock):
         logging.error(f"Exception in start_client: {err}")
 
 
+def start_spectator(w, sock):
+    """
+    Watch a session of the server without playing
+    """
+    try:
+        logger = logging.getLogger('CLIENT')
+        logger.info(f'Watching session {args.watch!r}')
+
+        myworld = Game()
+
+        # Spectators may receive many worlds per second, so limit the frames drawn
+        renderer = Renderer(w, max_fps=args.fps)
+
+        # Ask for the session to watch. Empty means the newest one
+        sock.send(f'{args.watch}\n'.encode())
+
+        # The worlds from the server are separated by new lines
+        sock_file = sock.makefile('rb')
+        for net_data in sock_file:
+            # Process data, print world
+            process_data(myworld, net_data, renderer)
+            if check_end(myworld) and myworld.reset is not None:
+                # Show the last world of the game before the next one
+                renderer.refresh(force=True)
+                process_world(myworld, myworld.reset, renderer)
+            renderer.refresh()
+        # The session ended, show the last world
+        renderer.refresh(force=True)
+    except Exception as err:
+        logging.error(f"Exception in start_spectator: {err}")
+
+
 def check_end(myworld):
     """
     Check if we reached the end
@@ -87,13 +139,21 @@ def check_end(myworld):
         return True
     return False
 
-def process_data(myworld, data, w):
+def process_data(myworld, data, renderer):
     """
     Process the data sent by the server
     """
     try:
         # convert to dict
-        data = json.loads(data)
+        process_world(myworld, json.loads(data), renderer)
+    except Exception as e:
+        logging.error(f'Error in process_data: {e}')
+
+def process_world(myworld, data, renderer):
+    """
+    Process a world sent by the server, already converted to a dict
+    """
+    try:
         myworld.size_x = int(data['size'].split('x')[0])
         myworld.size_y = int(data['size'].split('x')[1])
         myworld.current_reward = data['reward']
@@ -103,26 +163,25 @@ def process_data(myworld, data, w):
             myworld.world_score += data['reward']
         myworld.world_positions = data['positions']
         myworld.end = data['end']
+        myworld.reset = data.get('reset', None)
 
         # Print positions
-        minimum_y = 10
-        for x in range(myworld.size_x):
-            for y in range(myworld.size_y):
-                w.addstr(y + minimum_y, x, emoji.emojize(str(myworld.world_positions[x + (y * 10)])))
+        renderer.set_world(myworld.world_positions, myworld.size_x)
         # Print score
-        w.addstr(minimum_y + myworld.size_y + 1, 0, f"Score: {str(myworld.world_score):>5}")
+        renderer.set_text(1, f"Score: {str(myworld.world_score):>5}")
     except Exception as e:
-        logging.error(f'Error in process_data: {e}')
+        logging.error(f'Error in process_world: {e}')
 
-def get_key(myworld, w):
+def get_key(myworld, w, renderer):
     """
     Get a key from the user
     """
-    minimum_y = 10
+    # Show the world before waiting for the key
+    renderer.refresh(force=True)
     # Get a key
     key = w.getkey()
-    w.addstr(myworld.size_y + minimum_y + 2, 0, f'{key:<15}')
-    w.refresh()
+    renderer.set_text(2, f'{key:<15}')
+    renderer.refresh(force=True)
     return key
 
 
@@ -147,11 +206,20 @@ def main(w):
     server = args.server
     port = args.port
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((server, port))
+    if args.unix:
+        # Same host as the server, skip the TCP stack
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.unix)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((server, port))
 
-    # Start the client
-    start_client(w, sock)
+    if args.watch is not None:
+        # Only watch another session
+        start_spectator(w, sock)
+    else:
+        # Start the client
+        start_client(w, sock)
 
     sock.close()
 
@@ -211,6 +279,10 @@ if __name__ == '__main__':
     parser.add_argument('-d', '--debug', help='Debugging level. This shows more information about the flows.', action='store', required=False, type=int)
     parser.add_argument('-s', '--server', help='IP address of game server.', action='store', required=False, type=str, default='127.0.0.1')
     parser.add_argument('-p', '--port', help='Port of game server.', action='store', required=False, type=int, default=9000)
+    parser.add_argument('-u', '--unix', help='Path of the unix socket of the game server. Used instead of the IP and port when the server is in the same host.', action='store', required=False, type=str)
+    parser.add_argument('-w', '--watch', help='Watch the session with this id without playing. Without an id, watch the newest session. Use the spectator port of the server.', action='store', required=False, type=str, nargs='?', const='')
+    parser.add_argument('-f', '--fps', help='Max frames per second to draw when watching. 0 draws every world.', action='store', required=False, type=float, default=0)
+    parser.add_argument('-W', '--world', help='Name of the world to play, in servers with many worlds. Without it, the first world of the server.', action='store', required=False, type=str)
 
     args = parser.parse_args()
     logging.basicConfig(filename='client.log', filemode='a', format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s', datefmt='%H:%M:%S',level=logging.INFO)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Policy compiler for the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import argparse
+import logging
+import numpy as np
+
+__version__ = 'v0.1'
+
+# The level key of the Ground Floor, the level where the games start
+ground_floor = -1
+
+
+class Greedy_Policy(object):
+    """
+    Class Greedy_Policy
+    A q_table compiled to the greedy action of each level and state
+
+    actions[level_row, state] is the action to take
+    level_index[state] is the level_row to move to after a positive reward in state
+    The last row of actions is for levels that were never learned, and it is all 0
+    """
+    def __init__(self, levels, actions, level_index):
+        self.levels = levels
+        self.actions = actions
+        self.level_index = level_index
+        self.ground_floor = int(np.flatnonzero(levels == ground_floor)[0])
+
+
+def compile_q_table(q_table):
+    """
+    Compile a q_table, a dict of levels as saved by the agent, to a Greedy_Policy
+    """
+    levels = [ground_floor if level == 'GF' else int(level) for level in q_table]
+    n_states = len(next(iter(q_table.values())))
+    # Break ties by the first action, like the agent does when evaluating
+    actions = np.zeros((len(levels) + 1, n_states), dtype=np.uint8)
+    for row, level in enumerate(q_table):
+        actions[row] = np.argmax(np.asarray(q_table[level]), axis=1)
+    # Positive rewards in states that are not levels go to the empty last row
+    level_index = np.full(n_states, len(levels), dtype=np.int32)
+    for row, level in enumerate(levels):
+        if level != ground_floor:
+            level_index[level] = row
+    return Greedy_Policy(np.array(levels, dtype=np.int64), actions, level_index)
+
+
+def save_policy(filename, policy):
+    """
+    Save a policy as a npz file, without pickle
+    """
+    np.savez(filename, levels=policy.levels, actions=policy.actions, level_index=policy.level_index)
+
+
+def load_policy(filename):
+    """
+    Load a policy saved with save_policy()
+    """
+    with np.load(filename) as data:
+        return Greedy_Policy(data['levels'], data['actions'], data['level_index'])
+
+
+# Main
+####################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Hacker Grid World policy compiler version {__version__}. Author: Sebastian Garcia, eldraco@gmail.com", usage='%(prog)s -f <model.npy> -o <policy.npz> [options]')
+    parser.add_argument('-f', '--policyfile', help='Model saved by the agent, such as target-model.npy.', action='store', required=True, type=str)
+    parser.add_argument('-o', '--output', help='File of the compiled policy. Should end in .npz.', action='store', required=True, type=str)
+
+    args = parser.parse_args()
+    logging.basicConfig(filename='compile_policy.log', filemode='a', format='%(asctime)s, %(name)s: %(message)s', datefmt='%H:%M:%S', level=logging.CRITICAL)
+
+    q_table = np.load(args.policyfile, allow_pickle=True).item()
+    policy = compile_q_table(q_table)
+    save_policy(args.output, policy)
+    print(f'Compiled {len(policy.levels)} levels of {policy.actions.shape[1]} states to {args.output}')
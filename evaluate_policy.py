@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# Policy evaluator for the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import argparse
+import logging
+import time
+import numpy as np
+import world_generator
+from server import Game_HGW, load_world_config
+from compile_policy import compile_q_table, load_policy
+
+__version__ = 'v0.1'
+
+# How the episodes end
+end_by_object = 0
+end_by_timeout = 1
+end_by_loop = 2
+end_names = {end_by_object: 'object', end_by_timeout: 'timeout', end_by_loop: 'loop'}
+
+# The actions of the policies, in the order of the agent
+moves = ((0, -1), (0, 1), (-1, 0), (1, 0))
+
+
+class Policy_Evaluator(object):
+    """
+    Class Policy_Evaluator
+    Plays a greedy policy in a world from many starts at the same time
+
+    Each episode is a row of the arrays, and all of them are moved one step
+    at a time with array operations, following the same rules as the server.
+    The policy changes level after a positive reward, like the agent does.
+
+    Without a change of level or of the taken objects, the next position only
+    depends on the current one. So an episode that goes more steps than the
+    positions of the world without such a change is in a loop, and it would
+    go on until max_steps.
+    """
+    def __init__(self, conf, policy):
+        self.conf = conf
+        self.policy = policy
+        self.n_states = conf.size_x * conf.size_y
+
+        # Next position for each position and action
+        self.next_position = np.zeros((self.n_states, len(moves)), dtype=np.int64)
+        for position in range(self.n_states):
+            y, x = divmod(position, conf.size_x)
+            for action, (move_x, move_y) in enumerate(moves):
+                new_x = x + move_x
+                new_y = y + move_y
+                # Outside of the grid there are no walls, the boundaries keep the character inside
+                inside = 0 <= new_x < conf.size_x and 0 <= new_y < conf.size_y
+                if inside and new_x + (new_y * conf.size_x) in conf.walls:
+                    new_x, new_y = x, y
+                new_x = min(max(new_x, 0), conf.size_x - 1)
+                new_y = min(max(new_y, 0), conf.size_y - 1)
+                self.next_position[position, action] = new_x + (new_y * conf.size_x)
+
+        # The objects in each position, and how they behave
+        self.objects_at = np.zeros((self.n_states, len(conf.objects)), dtype=bool)
+        for index, obj in enumerate(conf.objects):
+            self.objects_at[obj.position, index] = True
+        self.object_rewards = np.array([obj.reward for obj in conf.objects], dtype=np.float64)
+        self.consumable = np.array([obj.consumable for obj in conf.objects], dtype=bool)
+        self.ends_game = np.array([obj.ends_game for obj in conf.objects], dtype=bool)
+
+    def step(self, positions, levels, taken):
+        """
+        Move the episodes one step
+        Returns the new positions, levels, taken flags and the rewards
+        """
+        positions = self.next_position[positions, self.policy.actions[levels, positions]]
+        # Objects not taken, or not consumable, are collected again
+        hits = self.objects_at[positions] & (~self.consumable | ~taken)
+        # If many objects are in the same position, the last one of the config gives the reward
+        # The move penalty goes after the objects, for the positions without any
+        hits_penalty = np.concatenate((hits[:, ::-1], np.ones((len(positions), 1), dtype=bool)), axis=1)
+        rewards = np.append(self.object_rewards[::-1], Game_HGW.move_penalty)[np.argmax(hits_penalty, axis=1)]
+        taken = taken | hits
+        # After a positive reward the agent moves to the level of that position
+        levels = np.where(rewards > 0, self.policy.level_index[positions], levels)
+        return positions, levels, taken, rewards
+
+    def evaluate(self, starts, levels):
+        """
+        Play an episode from each start position in each level row of the policy
+        Returns the returns, lengths and how each episode ended, as arrays of levels x starts
+        """
+        n_episodes = len(starts) * len(levels)
+        positions = np.tile(np.asarray(starts, dtype=np.int64), len(levels))
+        episode_levels = np.repeat(np.asarray(levels, dtype=np.int64), len(starts))
+        taken = np.tile(np.frombuffer(self.conf.taken, dtype=np.uint8).astype(bool), (n_episodes, 1))
+        steps = np.full(n_episodes, self.conf.max_steps, dtype=np.int64)
+        returns = np.zeros(n_episodes)
+        lengths = np.zeros(n_episodes, dtype=np.int64)
+        ends = np.full(n_episodes, -1, dtype=np.int64)
+        # Steps since the level or the taken objects changed
+        unchanged = np.zeros(n_episodes, dtype=np.int64)
+
+        playing = np.arange(n_episodes)
+        while playing.size:
+            new_positions, new_levels, new_taken, rewards = self.step(positions[playing], episode_levels[playing], taken[playing])
+            changed = (new_levels != episode_levels[playing]) | (new_taken != taken[playing]).any(axis=1)
+            positions[playing] = new_positions
+            episode_levels[playing] = new_levels
+            taken[playing] = new_taken
+            steps[playing] -= 1
+            returns[playing] += rewards
+            lengths[playing] += 1
+            unchanged[playing] = np.where(changed, 0, unchanged[playing] + 1)
+
+            # Same order of checks as the server
+            timeout = steps[playing] <= 0
+            by_object = ~timeout & (new_taken & self.ends_game).any(axis=1)
+            loop = ~timeout & ~by_object & (unchanged[playing] > self.n_states)
+            ends[playing[timeout]] = end_by_timeout
+            ends[playing[by_object]] = end_by_object
+            ends[playing[loop]] = end_by_loop
+            playing = playing[~(timeout | by_object | loop)]
+
+        looping = np.flatnonzero(ends == end_by_loop)
+        if looping.size:
+            self.finish_loops(looping, positions, episode_levels, taken, steps, returns, lengths)
+
+        shape = (len(levels), len(starts))
+        return returns.reshape(shape), lengths.reshape(shape), ends.reshape(shape)
+
+    def finish_loops(self, looping, positions, levels, taken, steps, returns, lengths):
+        """
+        Add the steps and rewards of the episodes in a loop until max_steps
+
+        After more steps than positions the episode is inside its cycle, so the
+        cycle is walked once to get its length and reward. The rest of the
+        steps are whole cycles and a part of one.
+        """
+        start = positions[looping]
+        level = levels[looping]
+        loop_taken = taken[looping]
+        remaining = steps[looping]
+        cycle_length = np.zeros(len(looping), dtype=np.int64)
+        cycle_reward = np.zeros(len(looping))
+        walking = np.ones(len(looping), dtype=bool)
+        position = start
+        while walking.any():
+            position, _, _, rewards = self.step(position, level, loop_taken)
+            cycle_length += walking
+            cycle_reward += np.where(walking, rewards, 0)
+            walking &= position != start
+        cycles, rest = np.divmod(remaining, cycle_length)
+        returns[looping] += cycles * cycle_reward
+        position = start
+        for step in range(int(rest.max())):
+            position, _, _, rewards = self.step(position, level, loop_taken)
+            returns[looping] += np.where(step < rest, rewards, 0)
+        lengths[looping] += remaining
+
+
+def reachable_starts(conf, start_x, start_y):
+    """
+    Get the empty positions that can be reached from the start of the character
+    """
+    free_mask = 0
+    occupied = set(obj.position for obj in conf.objects)
+    for position in range(conf.size_x * conf.size_y):
+        if position not in conf.walls:
+            free_mask |= 1 << position
+    reached = world_generator.flood_fill(1 << (start_x + (start_y * conf.size_x)), free_mask, conf.size_x, conf.size_y)
+    return [position for position in range(conf.size_x * conf.size_y) if reached >> position & 1 and position not in occupied]
+
+
+def print_map(conf, starts, values):
+    """
+    Print one value for each start position in the grid of the world
+    """
+    cells = {obj.position: obj.icon for obj in conf.objects}
+    cells.update(zip(starts, values))
+    for y in range(conf.size_y):
+        print(' '.join(f'{str(cells.get(x + (y * conf.size_x), ".")):>6}' for x in range(conf.size_x)))
+
+
+# Main
+####################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Hacker Grid World policy evaluator version {__version__}. Author: Sebastian Garcia, eldraco@gmail.com", usage='%(prog)s -f <model.npy|policy.npz> -c <server.conf> [options]')
+    parser.add_argument('-f', '--policyfile', help='Model saved by the agent (.npy) or policy compiled with compile_policy.py (.npz).', action='store', required=True, type=str)
+    parser.add_argument('-c', '--configfile', help='Configuration file of the server with the world to evaluate.', action='store', required=True, type=str)
+    parser.add_argument('-m', '--maps', help='Print the return and end of the episodes from each start in the grid.', action='store_true', required=False)
+    parser.add_argument('-o', '--output', help='Save the returns, lengths and ends of all the episodes to this npz file.', action='store', required=False, type=str)
+
+    args = parser.parse_args()
+    logging.basicConfig(filename='evaluate_policy.log', filemode='a', format='%(asctime)s, %(name)s: %(message)s', datefmt='%H:%M:%S', level=logging.CRITICAL)
+
+    conf = load_world_config(args.configfile)
+    if args.policyfile.endswith('.npz'):
+        policy = load_policy(args.policyfile)
+    else:
+        policy = compile_q_table(np.load(args.policyfile, allow_pickle=True).item())
+
+    start_x, start_y, _ = conf.characters[0]
+    starts = reachable_starts(conf, start_x, start_y)
+    # All the levels of the policy, without the empty row of the unknown levels
+    level_rows = list(range(len(policy.levels)))
+
+    start_time = time.perf_counter()
+    evaluator = Policy_Evaluator(conf, policy)
+    returns, lengths, ends = evaluator.evaluate(starts, level_rows)
+    elapsed = time.perf_counter() - start_time
+
+    print(f'Evaluated {returns.size} episodes from {len(starts)} starts in {len(level_rows)} levels in {elapsed * 1000:.1f} ms')
+    config_start = starts.index(start_x + (start_y * conf.size_x)) if start_x + (start_y * conf.size_x) in starts else None
+    for row, level in enumerate(policy.levels):
+        level_name = 'GF' if level == -1 else str(level)
+        counts = ', '.join(f'{name}: {np.count_nonzero(ends[row] == end)}' for end, name in end_names.items())
+        print(f'Level {level_name:>4}. Avg return: {returns[row].mean():9.2f}. Avg length: {lengths[row].mean():7.1f}. Ends by {counts}')
+        if args.maps:
+            print_map(conf, starts, [int(value) for value in returns[row]])
+            print_map(conf, starts, [end_names[end][0] for end in ends[row]])
+    if config_start is not None:
+        row = policy.ground_floor
+        print(f'From the start of the config in GF: return {returns[row, config_start]:.0f} in {lengths[row, config_start]} steps, ended by {end_names[ends[row, config_start]]}')
+    if args.output:
+        np.savez(args.output, starts=np.array(starts), levels=policy.levels, returns=returns, lengths=lengths, ends=ends)
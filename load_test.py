@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# Load generator for the server of the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+__version__ = 'v0.1'
+
+actions = ('UP', 'DOWN', 'LEFT', 'RIGHT')
+
+
+class Load_Stats(object):
+    """
+    Class Load_Stats
+    What the simulated agents measured during one level of load
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        # Seconds from sending a key to receiving its world
+        self.latencies = []
+        self.sessions = 0
+        self.errors = {}
+
+    def error(self, kind):
+        """
+        Count an error of this kind
+        """
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, clients):
+        """
+        Get the results of the level as a dict
+        """
+        elapsed = time.monotonic() - self.start
+        latencies = sorted(self.latencies)
+        steps = len(latencies)
+        errors = sum(self.errors.values())
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[int(fraction * (steps - 1))] * 1000, 3)
+
+        return {'clients': clients,
+                'seconds': round(elapsed, 3),
+                'steps': steps,
+                'steps_per_sec': round(steps / elapsed, 1),
+                'sessions': self.sessions,
+                'p50_ms': percentile(0.5),
+                'p99_ms': percentile(0.99),
+                'p999_ms': percentile(0.999),
+                'max_ms': percentile(1),
+                'errors': self.errors,
+                'error_rate': errors / (steps + errors) if steps + errors else 0}
+
+
+async def connect():
+    """
+    Open a connection to the server
+    """
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.server, args.port)
+
+
+def choose_action(rng, steps):
+    """
+    Get the next key of a simulated agent
+    """
+    if args.policy == 'random':
+        return rng.choice(actions)
+    if args.policy == 'cycle':
+        return actions[steps % len(actions)]
+    return args.policy
+
+
+async def simulated_agent(agent_id, stop):
+    """
+    Play sessions in the server until stop is set
+
+    The agent waits for the world of each key before sending the next one,
+    like agent.py does. After session_steps keys it disconnects and starts
+    a new session.
+    """
+    logger = logging.getLogger('LOAD')
+    rng = random.Random(agent_id)
+    while not stop.is_set():
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(connect(), args.timeout)
+            line = await asyncio.wait_for(reader.readline(), args.timeout)
+            if line.startswith(b'{"error"'):
+                stats.error('rejected')
+                await asyncio.sleep(args.think or 0.1)
+                continue
+            if args.world:
+                # The server starts in its first world, move to the chosen one
+                writer.write(f'WORLD {args.world}'.encode())
+                line = await asyncio.wait_for(reader.readline(), args.timeout)
+                if not line or line.startswith(b'{"error"'):
+                    stats.error('world')
+                    await asyncio.sleep(args.think or 0.1)
+                    continue
+            stats.sessions += 1
+            steps = 0
+            while not stop.is_set() and (not args.session_steps or steps < args.session_steps):
+                if args.think:
+                    await asyncio.sleep(rng.expovariate(1 / args.think))
+                sent = time.perf_counter()
+                writer.write(choose_action(rng, steps).encode())
+                line = await asyncio.wait_for(reader.readline(), args.timeout)
+                if not line:
+                    raise ConnectionError('Closed by the server')
+                stats.latencies.append(time.perf_counter() - sent)
+                # The world of a new game follows the last world of a game, unless it goes inside of it
+                # Checking the bytes is enough, and cheaper than parsing every world
+                if b'"end": true' in line and b'"reset": ' not in line:
+                    await asyncio.wait_for(reader.readline(), args.timeout)
+                steps += 1
+        except asyncio.TimeoutError:
+            stats.error('timeout')
+        except (ConnectionError, OSError) as e:
+            logger.info('Agent %s disconnected: %s', agent_id, e)
+            stats.error('connection')
+            await asyncio.sleep(args.think or 0.1)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+async def server_stats():
+    """
+    Get the stats of the server from its spectator port
+    """
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(args.server, args.spectator_port), args.timeout)
+        writer.write(b'STATS\n')
+        line = await asyncio.wait_for(reader.readline(), args.timeout)
+        writer.close()
+        return json.loads(line)
+    except (asyncio.TimeoutError, OSError, ValueError) as e:
+        return {'error': str(e)}
+
+
+async def load_test(levels, duration):
+    """
+    Run each level of concurrent agents for duration seconds
+    The agents of a level keep playing in the next ones, so the load only rises
+    """
+    global stats
+    stop = asyncio.Event()
+    agents = []
+    results = []
+    for clients in levels:
+        stats = Load_Stats()
+        while len(agents) < clients:
+            agents.append(asyncio.create_task(simulated_agent(len(agents), stop)))
+            # Start the agents in batches, so the connections do not overflow the backlog of the server
+            if len(agents) % 100 == 0:
+                await asyncio.sleep(0.01)
+        await asyncio.sleep(duration)
+        result = stats.report(clients)
+        if args.spectator_port:
+            result['server'] = await server_stats()
+        results.append(result)
+        print(f"Clients: {clients:6d}. Steps/sec: {result['steps_per_sec']:9.1f}. "
+              f"Latency p50: {result['p50_ms']} ms. p99: {result['p99_ms']} ms. p99.9: {result['p999_ms']} ms. Max: {result['max_ms']} ms. "
+              f"Sessions: {result['sessions']}. Error rate: {result['error_rate']:.2%} {result['errors']}", flush=True)
+    stop.set()
+    await asyncio.gather(*agents, return_exceptions=True)
+    return results
+
+
+# Main
+####################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Hacker Grid World load generator version {__version__}. Author: Sebastian Garcia, eldraco@gmail.com", usage='%(prog)s -l 10,100,1000 [options]')
+    parser.add_argument('-s', '--server', help='IP of game server.', action='store', required=False, type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', help='Port of game server.', action='store', required=False, type=int, default=9000)
+    parser.add_argument('-u', '--unix', help='Path of the unix socket of the game server. Used instead of the IP and port.', action='store', required=False, type=str)
+    parser.add_argument('-S', '--spectator_port', help='Spectator port of the server. If given, the stats of the server are added to the results of each level.', action='store', required=False, type=int)
+    parser.add_argument('-l', '--levels', help='Amounts of concurrent agents to test, separated by commas. Each level adds agents to the previous one.', action='store', required=False, type=str, default='1,10,100,1000')
+    parser.add_argument('-t', '--duration', help='Seconds to measure each level.', action='store', required=False, type=float, default=10)
+    parser.add_argument('-a', '--policy', help='Keys sent by the agents: random, cycle (UP, DOWN, LEFT, RIGHT in order) or a fixed key such as DOWN.', action='store', required=False, type=str, default='random')
+    parser.add_argument('-k', '--think', help='Mean seconds an agent waits before each key. The waits are exponentially distributed. 0 sends the next key as soon as the world arrives.', action='store', required=False, type=float, default=0)
+    parser.add_argument('-n', '--session_steps', help='Keys sent in each session before disconnecting and starting a new one. 0 keeps the session until the end of the test.', action='store', required=False, type=int, default=0)
+    parser.add_argument('-T', '--timeout', help='Seconds to wait for a connection or a world before counting a timeout.', action='store', required=False, type=float, default=10)
+    parser.add_argument('-W', '--world', help='Name of the world to play, in servers with many worlds. Without it, the first world of the server.', action='store', required=False, type=str)
+    parser.add_argument('-o', '--output', help='Write the results of all the levels to this json file.', action='store', required=False, type=str)
+
+    args = parser.parse_args()
+    logging.basicConfig(filename='load_test.log', filemode='a', format='%(asctime)s, %(name)s: %(message)s', datefmt='%H:%M:%S', level=logging.CRITICAL)
+
+    try:
+        import resource
+        # Each agent needs its own file descriptor
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    levels = [int(level) for level in args.levels.split(',')]
+    results = asyncio.run(load_test(levels, args.duration))
+    if args.output:
+        with open(args.output, 'w') as jfile:
+            json.dump(results, jfile, indent=4)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# Sparse q_table for the agents of the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import atexit
+import logging
+import os
+import pickle
+from collections import OrderedDict
+import numpy as np
+
+
+class QTable_Level(object):
+    """
+    Class QTable_Level
+    One level of the q_table
+
+    The states are split in blocks of block_size states. A block is only
+    allocated the first time one of its states is used, so the states
+    never visited use no memory.
+    """
+    def __init__(self, qtable, n_states, n_actions, block_size):
+        self.qtable = qtable
+        self.n_states = n_states
+        self.n_actions = n_actions
+        self.block_size = block_size
+        # Allocated blocks by block index
+        self.blocks = {}
+
+    def __getitem__(self, state):
+        """
+        Get the vector of action values of a state
+        It is a view, so changing it changes the q_table
+        """
+        block_index, offset = divmod(state, self.block_size)
+        try:
+            block = self.blocks[block_index]
+        except KeyError:
+            block = self.allocate(block_index)
+        return block[offset]
+
+    def __len__(self):
+        return self.n_states
+
+    def __iter__(self):
+        for state in range(self.n_states):
+            yield self[state]
+
+    def allocate(self, block_index):
+        """
+        Allocate the block of states with this index
+        """
+        if block_index < 0 or block_index * self.block_size >= self.n_states:
+            raise IndexError(f'State block {block_index} out of range')
+        # The last block can be shorter
+        length = min(self.block_size, self.n_states - (block_index * self.block_size))
+        block = np.zeros((length, self.n_actions))
+        self.blocks[block_index] = block
+        self.qtable.allocated(block.nbytes)
+        return block
+
+    def nbytes(self):
+        """
+        Bytes used by the allocated blocks
+        """
+        return sum(block.nbytes for block in self.blocks.values())
+
+    def to_dense(self):
+        """
+        Get the level as a dense array of n_states x n_actions
+        """
+        dense = np.zeros((self.n_states, self.n_actions))
+        for block_index, block in self.blocks.items():
+            start = block_index * self.block_size
+            dense[start:start + len(block)] = block
+        return dense
+
+    def from_dense(self, dense):
+        """
+        Fill the level from a dense array. Blocks that are all zeros are not allocated
+        """
+        for block_index in range(0, (self.n_states + self.block_size - 1) // self.block_size):
+            start = block_index * self.block_size
+            values = dense[start:start + self.block_size]
+            if np.any(values):
+                self.allocate(block_index)[:] = values
+
+
+class Sparse_QTable(object):
+    """
+    Class Sparse_QTable
+    The q_table as levels indexed by the 'state' that was used to 'enter' them
+
+    It works like the dict of levels used before, but the levels only
+    allocate the states that were visited. If the allocated memory goes over
+    memory_budget bytes, the levels used least recently are saved to disk in
+    a directory of this process inside spill_dir, and loaded back when they
+    are used again. The files are removed when the process ends.
+    """
+    def __init__(self, n_states, n_actions, block_size=64, memory_budget=None, spill_dir='qtable-spill'):
+        self.n_states = n_states
+        self.n_actions = n_actions
+        self.block_size = block_size
+        self.memory_budget = memory_budget
+        # Each process spills to its own directory, so agents can share spill_dir
+        self.spill_dir = os.path.join(spill_dir, str(os.getpid()))
+        if memory_budget is not None:
+            atexit.register(self.remove_spilled)
+        # Levels in memory, from the least to the most recently used
+        self.levels = OrderedDict()
+        # Levels saved to disk, and their files
+        self.spilled = {}
+        # All the levels in the order they were created, as in the dict of levels of the models
+        self.order = {}
+        # Bytes allocated by the levels in memory
+        self.nbytes = 0
+        self.logger = logging.getLogger('qtable')
+
+    def __contains__(self, level):
+        return level in self.levels or level in self.spilled
+
+    def __getitem__(self, level):
+        try:
+            self.levels.move_to_end(level)
+            return self.levels[level]
+        except KeyError:
+            if level in self.spilled:
+                return self.load(level)
+            raise
+
+    def __setitem__(self, level, dense):
+        """
+        Set a level from a dense array of n_states x n_actions
+        """
+        self.create_level(level).from_dense(dense)
+
+    def __iter__(self):
+        yield from list(self.order)
+
+    def __len__(self):
+        return len(self.levels) + len(self.spilled)
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def create_level(self, level):
+        """
+        Create an empty level, replacing it if it existed
+        """
+        if level in self:
+            self.delete_level(level)
+        qlevel = QTable_Level(self, self.n_states, self.n_actions, self.block_size)
+        self.levels[level] = qlevel
+        self.order[level] = None
+        return qlevel
+
+    def delete_level(self, level):
+        """
+        Delete a level from memory and disk
+        """
+        if level in self.levels:
+            self.nbytes -= self.levels.pop(level).nbytes()
+        if level in self.spilled:
+            os.remove(self.spilled.pop(level))
+        self.order.pop(level, None)
+
+    def allocated(self, nbytes):
+        """
+        Account for a new block, and spill levels if the budget was passed
+        """
+        self.nbytes += nbytes
+        if self.memory_budget is None:
+            return
+        # The most recently used level is the one being used, it is never spilled
+        while self.nbytes > self.memory_budget and len(self.levels) > 1:
+            level = next(iter(self.levels))
+            self.spill(level)
+
+    def spill(self, level):
+        """
+        Save a level to disk and free its memory
+        """
+        qlevel = self.levels.pop(level)
+        os.makedirs(self.spill_dir, exist_ok=True)
+        filename = os.path.join(self.spill_dir, f'level-{level}.npz')
+        block_indexes = np.array(sorted(qlevel.blocks), dtype=np.int64)
+        np.savez(filename, *[qlevel.blocks[block_index] for block_index in block_indexes], block_indexes=block_indexes)
+        self.spilled[level] = filename
+        self.nbytes -= qlevel.nbytes()
+        self.logger.info('Spilled q_table level %s to %s. Memory in use: %s bytes', level, filename, self.nbytes)
+
+    def load(self, level):
+        """
+        Load a spilled level back to memory
+        """
+        filename = self.spilled.pop(level)
+        qlevel = QTable_Level(self, self.n_states, self.n_actions, self.block_size)
+        self.levels[level] = qlevel
+        with np.load(filename) as data:
+            for position, block_index in enumerate(data['block_indexes']):
+                qlevel.blocks[int(block_index)] = data[f'arr_{position}']
+        os.remove(filename)
+        self.logger.info('Loaded q_table level %s from %s', level, filename)
+        # Accounting last, so the loaded level is not spilled again at once
+        self.allocated(qlevel.nbytes())
+        return qlevel
+
+    def remove_spilled(self):
+        """
+        Remove the files of the spilled levels. Used when the process ends
+        """
+        for level, filename in self.spilled.items():
+            self.order.pop(level, None)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        self.spilled = {}
+        try:
+            os.rmdir(self.spill_dir)
+        except OSError:
+            pass
+
+    def dense_levels(self):
+        """
+        Get the levels as dense arrays, one at a time, in the order they were created
+        The spilled levels are read from disk without loading them back
+        """
+        for level in list(self.order):
+            if level in self.levels:
+                yield level, self.levels[level].to_dense()
+                continue
+            dense = np.zeros((self.n_states, self.n_actions))
+            with np.load(self.spilled[level]) as data:
+                for position, block_index in enumerate(data['block_indexes']):
+                    start = int(block_index) * self.block_size
+                    block = data[f'arr_{position}']
+                    dense[start:start + len(block)] = block
+            yield level, dense
+
+    def to_dict(self):
+        """
+        Get the q_table as a dict of dense arrays, as it is saved in the models
+        All the levels are dense at the same time, to save the models use save()
+        """
+        return dict(self.dense_levels())
+
+    def save(self, filename):
+        """
+        Save the q_table as the dict of dense levels in a .npy file, read with np.load(...).item()
+
+        Without a memory budget it is np.save of to_dict(). With a budget, the
+        dict is pickled one level at a time, so saving does not pass the budget.
+        The bytes are not the same as with np.save, but np.load reads the same dict.
+        """
+        if self.memory_budget is None:
+            np.save(filename, self.to_dict())
+            return
+        if not filename.endswith('.npy'):
+            filename += '.npy'
+        model = np.empty((), dtype=object)
+        model[()] = self
+        with open(filename, 'wb') as fi:
+            np.lib.format.write_array_header_1_0(fi, np.lib.format.header_data_from_array_1_0(model))
+            Levels_Pickler(fi).dump(model)
+
+    def save_txt(self, filename):
+        """
+        Save the q_table as the text of the dict of dense levels, one level at a time
+        """
+        with open(filename, 'w') as fi:
+            fi.write('{')
+            for position, (level, dense) in enumerate(self.dense_levels()):
+                if position:
+                    fi.write(', ')
+                fi.write(f'{level!r}: {dense!r}')
+            fi.write('}')
+
+
+class Levels_Pickler(pickle.Pickler):
+    """
+    Class Levels_Pickler
+    Pickles a Sparse_QTable as the dict of its dense levels
+
+    The pickler writes the items of the dict as it gets them from
+    dense_levels(). Without the memo (fast mode) the levels already written
+    are not kept, so np.load reads a plain dict but only a few levels were
+    dense at a time.
+    """
+    def __init__(self, file):
+        super().__init__(file, protocol=3)
+        self.fast = True
+
+    def reducer_override(self, obj):
+        if isinstance(obj, Sparse_QTable):
+            return (dict, (), None, None, obj.dense_levels())
+        return NotImplemented
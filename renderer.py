@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Curses renderer for the client and agent of the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import time
+import emoji
+
+
+class Renderer(object):
+    """
+    Class Renderer
+    Draws the worlds in a curses window
+
+    The worlds and texts are only stored when they arrive. They are drawn
+    in refresh(), which only draws the positions and texts that changed
+    since the last frame, and at most max_fps times per second.
+    """
+    def __init__(self, w, minimum_y=10, max_fps=0):
+        self.w = w
+        # Row of the window where the world starts
+        self.minimum_y = minimum_y
+        # 0 means no limit of frames per second
+        self.frame_time = 1 / max_fps if max_fps else 0
+        self.last_refresh = 0
+        # What should be on the screen
+        self.positions = []
+        self.size_x = 0
+        self.texts = {}
+        # What is on the screen
+        self.screen_positions = []
+        self.screen_size_x = 0
+        self.screen_texts = {}
+        # Each icon is emojized only once
+        self.glyphs = {}
+
+    def glyph(self, icon):
+        """
+        Get the glyph to draw for an icon
+        """
+        try:
+            return self.glyphs[icon]
+        except KeyError:
+            glyph = emoji.emojize(str(icon))
+            self.glyphs[icon] = glyph
+            return glyph
+
+    def set_world(self, positions, size_x):
+        """
+        Store the positions of the world to draw
+        """
+        self.positions = positions
+        self.size_x = size_x
+
+    def set_text(self, row, text):
+        """
+        Store a text to draw in a row below the world
+        """
+        self.texts[row] = text
+
+    def refresh(self, force=False):
+        """
+        Draw what changed since the last frame and refresh the window
+        Returns False if the frame was skipped because it came too fast
+        """
+        now = time.monotonic()
+        if not force and now - self.last_refresh < self.frame_time:
+            return False
+        self.last_refresh = now
+
+        if self.size_x != self.screen_size_x or len(self.positions) != len(self.screen_positions):
+            # A new shape of world, draw everything again
+            self.w.move(self.minimum_y, 0)
+            self.w.clrtobot()
+            self.screen_positions = [None] * len(self.positions)
+            self.screen_size_x = self.size_x
+            self.screen_texts = {}
+
+        # Positions go row by row, so the cursor moves forward in the window
+        for position, (icon, screen_icon) in enumerate(zip(self.positions, self.screen_positions)):
+            if icon != screen_icon:
+                y, x = divmod(position, self.size_x)
+                self.w.addstr(y + self.minimum_y, x, self.glyph(icon))
+        self.screen_positions = self.positions
+
+        size_y = len(self.positions) // self.size_x if self.size_x else 0
+        for row, text in self.texts.items():
+            if self.screen_texts.get(row) != text:
+                self.w.addstr(self.minimum_y + size_y + row, 0, text)
+                self.screen_texts[row] = text
+
+        self.w.refresh()
+        return True
@@ -5,8 +5,15 @@
 import argparse
 import logging
 import json
+import os
+import sys
 import time
+import copy
 import asyncio
+import functools
+import itertools
+import world_generator
+from tracing import Sampled_Tracer, setup_logging
 
 __version__ = 'v0.1'
 
@@ -17,18 +24,52 @@ async def server(host, port):
     """
     logger = logging.getLogger('SERVER')
     logger.info('Starting server')
-    server = await asyncio.start_server(handle_new_client, host, port)
-    addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets)
+    servers = [await asyncio.start_server(handle_new_client, host, port)]
+    # Clients in the same host can use a unix socket, which is faster than TCP
+    unix_socket = confjson.get('unix_socket', None)
+    if unix_socket:
+        servers.append(await asyncio.start_unix_server(handle_new_client, unix_socket))
+    # Spectators connect to their own port
+    spectator_port = confjson.get('spectator_port', None)
+    if spectator_port:
+        servers.append(await asyncio.start_server(handle_new_spectator, host, spectator_port))
+    stats_interval = confjson.get('stats_interval', None)
+    if stats_interval:
+        asyncio.create_task(report_stats(stats_interval))
+    # Compile again the configs of the worlds that change
+    reload_interval = confjson.get('reload_interval', 1)
+    if reload_interval:
+        asyncio.create_task(watch_configs(reload_interval))
+    addrs = ', '.join(str(sock.getsockname()) for server in servers for sock in server.sockets)
     logger.info(f'Serving on {addrs}')
-    async with server:
-        await server.serve_forever()
+    await asyncio.gather(*(server.serve_forever() for server in servers))
 
 
-async def send_world(writer, world_json):
+def encode_world(world_env):
+    """
+    Convert the world to the bytes sent to the clients
+    Each world ends with a new line so the client can separate them
+    """
+    return (json.dumps(world_env) + '\n').encode()
+
+
+def encode_reset(frame, reset_frame):
+    """
+    Put the first world of the next game in the 'reset' key of the last world of a game
+    Both are already encoded, so they are joined as bytes
+    """
+    return frame[:-2] + b', "reset": ' + reset_frame[:-1] + b'}\n'
+
+
+async def send_world(writer, frame, session):
     """
     Send the world to the client
+    The same bytes are sent to the spectators of the session
+    A client that does not read its worlds for step_timeout seconds is dropped
     """
-    writer.write(bytes(str(world_json).encode()))
+    writer.write(frame)
+    session.broadcast(frame)
+    await asyncio.wait_for(writer.drain(), step_timeout)
 
 async def handle_new_client(reader, writer):
     """
@@ -36,152 +77,779 @@ async def handle_new_client(reader, writer):
     """
     logger = logging.getLogger('SERVER')
     addr = writer.get_extra_info('peername')
-    logger.info(f"Handling data from client {addr}")
+
+    if max_sessions and len(sessions) >= max_sessions:
+        # Shed the new client instead of slowing down the sessions being played
+        logger.critical(f'Server full with {len(sessions)} sessions. Rejecting client {addr}')
+        server_stats['rejected'] += 1
+        writer.write((json.dumps({'error': 'Server full'}) + '\n').encode())
+        writer.close()
+        return
+
+    logger.info('Handling data from client %s', addr)
+
+    # Register the session so spectators can watch it
+    session = Session(next(session_ids), addr)
+    sessions[session.id] = session
+
+    try:
+        # Clients start in the first world, and can move to another one with WORLD <name>
+        hosted = worlds[default_world]
+        while hosted is not None:
+            session.world = hosted.name
+            if hosted.shared():
+                # Each client plays one of the characters of a shared world
+                hosted = await play_shared_world(reader, writer, session, hosted)
+            else:
+                hosted = await play_world(reader, writer, session, hosted)
+    except asyncio.TimeoutError:
+        logger.info('Session %s of client %s reaped. It did not play or read for too long.', session.id, addr)
+        server_stats['reaped'] += 1
+    except ConnectionError as e:
+        logger.info('Client disconnected: %s', e)
+    except Exception as e:
+        logger.error(f'Error in session {session.id} of client {addr}: {e}')
+    finally:
+        del sessions[session.id]
+        session.close()
+        writer.close()
+
+
+async def change_world(writer, message):
+    """
+    Get the world asked with WORLD <name>
+    If there is no world with that name, the client gets an error and the session ends
+    """
+    name = message[len('WORLD '):].strip()
+    if name in worlds:
+        return worlds[name]
+    writer.write((json.dumps({'error': f'No world {name}'}) + '\n').encode())
+    await writer.drain()
+    return None
+
+
+async def play_world(reader, writer, session, hosted):
+    """
+    Play worlds with one client
+    In worlds with one character the client can send macro actions, such as UP*4
+    In worlds with many characters the client sends the keys of all of them
+    separated by commas, such as UP,LEFT
+    Returns the world asked by the client to play next, or None when it leaves
+    """
+    logger = logging.getLogger('SERVER')
+    addr = session.addr
 
     # Get a new world
-    myworld = Game_HGW()
+    myworld = Game_HGW(hosted.next_config())
     world_env = myworld.get_world()
+    session.game = myworld
 
     # Send the first world
     # Convert world to json before sending
-    world_json = json.dumps(world_env)
-    logger.info(f"Sending: {world_json!r}")
-    await send_world(writer, world_json)
-    await writer.drain()
+    frame = encode_world(world_env)
+    logger.info('Sending: %r', frame)
+    await send_world(writer, frame, session)
 
     while True:
-        try:
-            data = await reader.read(20)
+        # A client that does not send actions for idle_timeout seconds is dropped
+        data = await asyncio.wait_for(reader.read(1024), idle_timeout)
+        if not data:
+            logger.info('Connection closed. Client %s disconnected.', addr)
+            break
+        message = data.decode()
+        session.last_activity = time.monotonic()
+
+        # Only the sampled steps are logged, the rest do not format anything
+        session.tracer.step()
+        session.tracer.log(logger, 'Received %r from %s', message, addr)
+
+        if message.startswith('WORLD '):
+            return await change_world(writer, message)
+
+        if len(myworld.conf.characters) == 1:
+            myworld.process_input_macro(message)
+        else:
+            myworld.process_input_keys(message.split(','))
+
+        # Convert world to json before sending
+        frame = encode_world(world_env)
+        reset_frame = None
+
+        # If the game ended, reset
+        if myworld.world['end']:
+            del myworld
+
+            myworld = Game_HGW(hosted.next_config())
+            world_env = myworld.get_world()
+            session.game = myworld
+
+            # The first world of the next game
+            reset_frame = encode_world(world_env)
+            if auto_reset:
+                # Goes inside the last world of this game, in one message
+                frame = encode_reset(frame, reset_frame)
+                reset_frame = None
+
+        session.tracer.log(logger, 'Sending: %r', frame)
+        await send_world(writer, frame, session)
+        if reset_frame is not None:
+            # The worlds are separated by new lines, so the next one can be sent at once
+            session.tracer.log(logger, 'Sending: %r', reset_frame)
+            await send_world(writer, reset_frame, session)
+
+        # Cooldown period
+        # Each key inputted is forced to wait a little
+        # This should be at least 0.1 for human play or replay mode
+        # Should be 0 for agents to play
+        # Only this session waits, the rest keep playing
+        if myworld.speed:
+            await asyncio.sleep(myworld.speed)
+    return None
+
+
+async def play_shared_world(reader, writer, session, hosted):
+    """
+    Play one character of a shared world
+    The client gets the world as if it was alone, with its own reward and position
+    Returns the world asked by the client to play next, or None when it leaves
+    """
+    logger = logging.getLogger('SERVER')
+    addr = session.addr
+
+    # Join a world with a free character, or start a new one
+    shared = next((lobby for lobby in hosted.lobbies if not lobby.full()), None)
+    if shared is None:
+        shared = Shared_World(hosted)
+        hosted.lobbies.append(shared)
+    index = shared.join()
+    session.game = shared.game
+    logger.info('Client %s plays character %s', addr, index)
+
+    try:
+        frame = shared.frame(index)
+        logger.info('Sending: %r', frame)
+        await send_world(writer, frame, session)
+
+        while True:
+            # A client that does not send actions for idle_timeout seconds is dropped
+            data = await asyncio.wait_for(reader.read(1024), idle_timeout)
+            if not data:
+                logger.info('Connection closed. Client %s disconnected.', addr)
+                break
             message = data.decode()
+            session.last_activity = time.monotonic()
+
+            session.tracer.step()
+            session.tracer.log(logger, 'Received %r from %s for character %s', message, addr, index)
+
+            if message.startswith('WORLD '):
+                return await change_world(writer, message)
 
-            logger.info(f"Received {message!r} from {addr}")
+            # Wait until the rest of the agents sent their keys
+            frames = await shared.step(index, message)
+            session.game = shared.game
+            for frame in frames[index]:
+                session.tracer.log(logger, 'Sending: %r', frame)
+                await send_world(writer, frame, session)
+
+            # Cooldown period
+            if shared.game.speed:
+                await asyncio.sleep(shared.game.speed)
+    finally:
+        shared.leave(index)
+        if not shared.agents:
+            hosted.lobbies.remove(shared)
+    return None
 
-            myworld.process_input_key(message)
 
-            # Convert world to json before sending
-            world_json = json.dumps(world_env)
+class Shared_World(object):
+    """
+    Class Shared_World
+    A world with several characters, each one played by its own client
+
+    The world steps once all the clients playing it sent their key, so the
+    moves of the characters are resolved together. The characters without
+    a client, or whose client did not send its key in shared_step_timeout
+    seconds, do not move. Each game uses the current config of the hosted
+    world, so after a reload the next game uses the new one.
+    """
+    def __init__(self, hosted):
+        self.hosted = hosted
+        self.game = Game_HGW(hosted.next_config())
+        # Indexes of the characters being played
+        self.agents = set()
+        # Keys received for the next step, by character
+        self.keys = {}
+        # Future with the frames of the next step
+        self.next_step = None
+
+    def full(self):
+        """
+        True if all the characters are being played
+        """
+        return len(self.agents) >= len(self.game.conf.characters)
+
+    def join(self):
+        """
+        Take the first free character. Returns its index
+        """
+        index = min(set(range(len(self.game.conf.characters))) - self.agents)
+        self.agents.add(index)
+        return index
+
+    def leave(self, index):
+        """
+        Free a character. It stays in the world without moving
+        """
+        self.agents.discard(index)
+        self.keys.pop(index, None)
+        # The rest of the agents may be waiting only for this one
+        if self.agents and self.next_step is not None and self.agents <= set(self.keys):
+            self.process()
+
+    def frame(self, index):
+        """
+        Get the world as seen by one character
+        """
+        world = dict(self.game.world)
+        world['agent'] = index
+        world['reward'] = self.game.rewards[index]
+        world['current_character_position'] = world['character_positions'][index]
+        return encode_world(world)
+
+    async def step(self, index, key):
+        """
+        Store the key of a character and wait for the step
+        Returns the frames to send to each character
+        """
+        if self.next_step is None:
+            self.next_step = asyncio.get_running_loop().create_future()
+        next_step = self.next_step
+        self.keys[index] = key
+        if self.agents <= set(self.keys):
+            self.process()
+        try:
+            return await asyncio.wait_for(asyncio.shield(next_step), shared_step_timeout or None)
+        except asyncio.TimeoutError:
+            # Step without the keys that did not arrive, unless another character already did
+            if self.next_step is next_step:
+                self.process()
+            return await next_step
+
+    def process(self):
+        """
+        Step the world with the keys of all the characters
+        """
+        keys = [self.keys.get(index, '') for index in range(len(self.game.conf.characters))]
+        self.game.process_input_keys(keys)
+        # The world is encoded once, and each character gets its own reward and position appended
+        frames = self.shared_frames()
+        if self.game.world['end']:
+            conf = self.hosted.next_config()
+            # The clients keep their characters, so a new config without enough of them waits for a new world
+            if max(self.agents, default=0) >= len(conf.characters):
+                conf = self.game.conf
+            self.game = Game_HGW(conf)
+            for index, reset_frame in self.shared_frames().items():
+                if auto_reset:
+                    frames[index] = [encode_reset(frames[index][0], reset_frame[0])]
+                else:
+                    frames[index].append(reset_frame[0])
+        next_step, self.next_step = self.next_step, None
+        self.keys = {}
+        next_step.set_result(frames)
+
+    def shared_frames(self):
+        """
+        Get the frames of all the characters being played, as lists
+        """
+        shared = json.dumps(self.game.world)[:-1]
+        frames = {}
+        for index in self.agents:
+            position = self.game.world['character_positions'][index]
+            frames[index] = [f'{shared}, "agent": {index}, "reward": {json.dumps(self.game.rewards[index])}, "current_character_position": {position}}}\n'.encode()]
+        return frames
+
+
+def get_stats():
+    """
+    Get the sessions and the memory they use
+    """
+    memory = [session.memory_usage() for session in sessions.values()]
+    # The game of a shared world is played by several sessions, in the total it is counted once
+    games = {id(session.game): session.game for session in sessions.values() if session.game is not None}
+    sessions_memory = sum(session.memory_usage(game=False) for session in sessions.values()) + sum(game.memory_usage() for game in games.values())
+    stats = {
+        'sessions': len(sessions),
+        'rejected': server_stats['rejected'],
+        'reaped': server_stats['reaped'],
+        'sessions_memory': sessions_memory,
+        'max_session_memory': max(memory, default=0),
+        'avg_session_memory': sessions_memory / len(memory) if memory else 0,
+        }
+    try:
+        import resource
+        # Kilobytes in Linux, bytes in macOS
+        stats['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        pass
+    return stats
+
+
+async def report_stats(interval):
+    """
+    Log the stats of the server every interval seconds
+    """
+    logger = logging.getLogger('SERVER')
+    while True:
+        await asyncio.sleep(interval)
+        stats = get_stats()
+        logger.critical(f"Sessions: {stats['sessions']}. Rejected: {stats['rejected']}. Reaped: {stats['reaped']}. Sessions memory: {stats['sessions_memory']} bytes. Avg per session: {stats['avg_session_memory']:.0f} bytes. Max per session: {stats['max_session_memory']} bytes. Max RSS: {stats.get('max_rss', None)}")
+
+
+async def handle_new_spectator(reader, writer):
+    """
+    Function to deal with each new spectator
+
+    The spectator sends one line with the id of the session to watch, an
+    empty line to watch the newest session, LIST to get the sessions,
+    WORLDS to get the worlds, or STATS to get the stats of the server.
+    After that it only receives the worlds of the session, it can not play.
+    """
+    logger = logging.getLogger('SERVER')
+    addr = writer.get_extra_info('peername')
+    session = None
+    try:
+        request = (await reader.readline()).decode().strip()
+        if request == 'LIST':
+            now = time.monotonic()
+            sessions_list = [{'id': session.id,
+                              'addr': str(session.addr),
+                              'world': session.world,
+                              'memory': session.memory_usage(),
+                              'idle': round(now - session.last_activity, 3)} for session in sessions.values()]
+            writer.write((json.dumps({'sessions': sessions_list}) + '\n').encode())
+            await writer.drain()
+            return
+        if request == 'WORLDS':
+            worlds_list = [{'name': hosted.name,
+                            'configfile': hosted.configfile,
+                            'sessions': sum(session.world == hosted.name for session in sessions.values())} for hosted in worlds.values()]
+            writer.write((json.dumps({'worlds': worlds_list}) + '\n').encode())
+            await writer.drain()
+            return
+        if request == 'STATS':
+            writer.write((json.dumps(get_stats()) + '\n').encode())
+            await writer.drain()
+            return
+        if request:
+            session = sessions.get(int(request), None)
+        elif sessions:
+            session = sessions[max(sessions)]
+        if session is None:
+            writer.write((json.dumps({'error': f'No session {request}'}) + '\n').encode())
+            await writer.drain()
+            return
+
+        logger.info('Spectator %s watching session %s', addr, session.id)
+        session.add_spectator(writer)
+        # Spectators do not play, wait until they leave or the session ends
+        while await reader.read(1024):
+            pass
+    except (ConnectionError, ValueError) as e:
+        logger.info('Spectator %s disconnected: %s', addr, e)
+    finally:
+        if session is not None:
+            session.spectators.discard(writer)
+        writer.close()
+
+
+class Session(object):
+    """
+    Class Session
+    A client playing in the server, and the spectators watching it
+    """
+    def __init__(self, session_id, addr):
+        self.id = session_id
+        self.addr = addr
+        # Name of the world being played
+        self.world = None
+        self.game = None
+        self.last_activity = time.monotonic()
+        self.spectators = set()
+        # Last world sent, so new spectators see something at once
+        self.last_frame = None
+        # Only 1 in trace_sessions sessions is traced, in 1 of every trace_steps steps
+        traced = trace_sessions and session_id % trace_sessions == 0
+        self.tracer = Sampled_Tracer(trace_steps if traced else 0)
+
+    def add_spectator(self, writer):
+        """
+        Add a spectator and send it the last world
+        """
+        self.spectators.add(writer)
+        if self.last_frame is not None:
+            writer.write(self.last_frame)
+
+    def broadcast(self, frame):
+        """
+        Send the same bytes to all the spectators
 
-            logger.info(f"Sending: {world_json!r}")
-            await send_world(writer, world_json)
+        A spectator that did not read the previous worlds yet loses this one,
+        so slow spectators never slow down the player
+        """
+        self.last_frame = frame
+        for writer in self.spectators:
+            if writer.is_closing() or writer.transport.get_write_buffer_size() > spectator_buffer:
+                continue
+            writer.write(frame)
+
+    def memory_usage(self, game=True):
+        """
+        Get the bytes used by the session, with its game or without it
+        """
+        memory = sys.getsizeof(self) + sys.getsizeof(self.spectators)
+        if self.last_frame is not None:
+            memory += sys.getsizeof(self.last_frame)
+        if game and self.game is not None:
+            memory += self.game.memory_usage()
+        return memory
+
+    def close(self):
+        """
+        End the session and disconnect the spectators
+        """
+        for writer in self.spectators:
+            writer.close()
+        self.spectators.clear()
+
+
+class World_Object(object):
+    """
+    Class World_Object
+    One object of the world compiled from the config
+    It never changes while playing, the games keep their own taken flags
+    """
+    __slots__ = ('name', 'x', 'y', 'position', 'icon', 'reward', 'taken', 'ends_game', 'consumable', 'solid')
+
+    def __init__(self, name, obj_conf, size_x):
+        self.name = name
+        self.x = obj_conf['x']
+        self.y = obj_conf['y']
+        # The objects are stored as pos = X + (Y * X_size)
+        self.position = self.x + (self.y * size_x)
+        self.icon = obj_conf['icon']
+        # Some objects do not have all the keys in the config
+        self.reward = obj_conf.get('reward', 0)
+        self.taken = obj_conf.get('taken', False)
+        self.ends_game = obj_conf.get('ends_game', False)
+        self.consumable = obj_conf.get('consumable', False)
+        self.solid = obj_conf.get('solid', False)
+
+
+class World_Config(object):
+    """
+    Class World_Config
+    The config of a world compiled once when it is loaded
+    All the games of the world share it
+    """
+    __slots__ = ('size_x', 'size_y', 'reward', 'max_steps', 'speed',
+                 'characters',
+                 'objects', 'taken', 'walls', 'ends_game', 'objects_at')
+
+    def __init__(self, confjson):
+        self.size_x = confjson['world'].get('size_x', None)
+        self.size_y = confjson['world'].get('size_y', None)
+        self.reward = confjson['world'].get('reward', 0)
+        self.max_steps = confjson['max_steps']
+        self.speed = confjson.get('speed', 0)
+
+        # The characters are stored apart from the rest of the objects, as (x, y, icon)
+        # There is one for each agent playing in the world, such as 'character' and 'character2'
+        self.characters = tuple((obj['x'], obj['y'], obj['icon']) for name, obj in confjson['objects'].items() if 'character' in name)
+
+        self.objects = tuple(World_Object(name, confjson['objects'][name], self.size_x) for name in confjson['objects'] if not 'character' in name)
+        # Initial taken flags, one byte per object
+        self.taken = bytes(obj.taken for obj in self.objects)
+        # Positions that can not be crossed
+        self.walls = frozenset(obj.position for obj in self.objects if obj.solid)
+        # Indexes of the objects that end the game when taken
+        self.ends_game = tuple(index for index, obj in enumerate(self.objects) if obj.ends_game)
+        # Indexes of the objects in each position, in the order of the config
+        objects_at = {}
+        for index, obj in enumerate(self.objects):
+            objects_at.setdefault(obj.position, []).append(index)
+        self.objects_at = {position: tuple(indexes) for position, indexes in objects_at.items()}
+        logging.info('Compiled world %sx%s with %s objects', self.size_x, self.size_y, len(self.objects))
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_generated_world(seed, params):
+    """
+    Generate and compile the world of a seed
+    The compiled worlds are cached, so the params are a tuple to be part of the key
+    """
+    return World_Config(world_generator.generate_world(seed, **dict(params)))
+
+
+class Hosted_World(object):
+    """
+    Class Hosted_World
+    A world served by the server, that the clients choose by name
+
+    The config is compiled when it is loaded, and compiled again when its
+    file changes. The games being played keep the config they started with,
+    so only the next games use the new one.
+    """
+    def __init__(self, configfile, confjson):
+        self.configfile = configfile
+        # The name is in the config, or it is the name of the file without .conf
+        name = os.path.basename(configfile)
+        self.name = confjson.get('name', name[:-len('.conf')] if name.endswith('.conf') else name)
+        self.mtime = os.stat(configfile).st_mtime_ns
+        self.episode_counter = itertools.count()
+        # Shared worlds being played, a new client takes a free character of one of them
+        self.lobbies = []
+        self.compile(confjson)
+
+    def compile(self, confjson):
+        """
+        Compile a config and start using it
+        If the config is not valid it fails before replacing the old one
+        """
+        generator = confjson.get('generator')
+        if generator:
+            # A different generated world for each episode
+            generator = dict(generator)
+            generator_seed = generator.pop('seed', 0)
+            generator_worlds = generator.pop('worlds', None)
+            generator.setdefault('speed', confjson.get('speed', 0))
+            generator_params = tuple(sorted(generator.items()))
+            # Generate the first world now, so an invalid generator fails here
+            compile_generated_world(generator_seed, generator_params)
+            world_config = None
+        else:
+            generator_params = generator_seed = generator_worlds = None
+            world_config = World_Config(confjson)
+        # Nothing else runs in the server between these assignments
+        self.world_config = world_config
+        self.generator_params = generator_params
+        self.generator_seed = generator_seed
+        self.generator_worlds = generator_worlds
+
+    def shared(self):
+        """
+        True if each client plays one of the characters of this world
+        """
+        return self.world_config is not None and len(self.world_config.characters) > 1 and not batched_agents
+
+    def next_config(self):
+        """
+        Get the compiled world for a new episode
+        If the config has a generator, each episode gets the next generated world
+        """
+        if self.generator_params is None:
+            return self.world_config
+        episode = next(self.episode_counter)
+        if self.generator_worlds:
+            # Cycle over a fixed set of worlds
+            episode = episode % self.generator_worlds
+        return compile_generated_world(self.generator_seed + episode, self.generator_params)
+
+    def reload(self):
+        """
+        Compile the config again if its file changed
+        Returns True if it was compiled
+        """
+        mtime = os.stat(self.configfile).st_mtime_ns
+        if mtime == self.mtime:
+            return False
+        # If the file is not valid yet, it is tried again when it changes again
+        self.mtime = mtime
+        self.compile(read_configfile(self.configfile))
+        return True
+
+
+async def watch_configs(interval):
+    """
+    Compile again the worlds whose config file changed, every interval seconds
+    The sessions being played continue, and their next games use the new config
+    """
+    logger = logging.getLogger('SERVER')
+    while True:
+        await asyncio.sleep(interval)
+        for hosted in worlds.values():
             try:
-                await writer.drain()
-            except ConnectionResetError:
-                logger.info(f'Connection lost. Client disconnected.')
-
-            # If the game ended, reset and resend
-            if myworld.world['end']:
-                del myworld
-
-                myworld = Game_HGW()
-                world_env = myworld.get_world()
-
-                # Necessary to give time to the socket to send the old world before sending the new. If not they look like one message
-                time.sleep(0.01)
-
-                # Send the first world
-                # Convert world to json before sending
-                world_json = json.dumps(world_env)
-                logger.info(f"Sending: {world_json!r}")
-                await send_world(writer, world_json)
-                try:
-                    await writer.drain()
-                except ConnectionResetError:
-                    logger.info(f'Connection lost. Client disconnected.')
-        except Exception as e:
-            logger.info(f"Client disconnected: {e}")
-            break
+                if hosted.reload():
+                    logger.critical(f'Reloaded world {hosted.name} from {hosted.configfile}')
+            except Exception as e:
+                logger.error(f'Error reloading world {hosted.name}. Keeping the previous config: {e}')
+
+
+def read_configfile(configfile):
+    """
+    Read a config file
+    In test mode the speed of all the worlds is 0.1
+    """
+    with open(configfile, 'r') as jfile:
+        confjson = json.load(jfile)
+    if args.test:
+        confjson['speed'] = 0.1
+    return confjson
+
+
+def load_world_config(configfile):
+    """
+    Read a config file and compile its world
+    """
+    with open(configfile, 'r') as jfile:
+        return World_Config(json.load(jfile))
 
 
 class Game_HGW(object):
     """
     Class Game_HGW
     Organizes and implements the logic of the game
+
+    A world can have several characters, one for each agent. All of them
+    move in the same step, and share the objects of the world.
     """
-    def __init__(self):
+    __slots__ = ('conf', 'world', 'characters_x', 'characters_y', 'rewards', 'taken', 'steps', 'speed')
+
+    # Move penalty
+    move_penalty = -1
+    # Max steps played for one macro action
+    max_action_repeat = 100
+    # Iconography
+    background = ' '
+
+    def __init__(self, conf):
         """
         Initialize the game env
         Returns a game object
 
         The game has a world, with characters and positions
         it also has rules, rewards actions and dynamics of movements
+        The fixed parts come from the compiled World_Config
         """
-        # Read the conf
-        with open(args.configfile, 'r') as jfile:
-            confjson = json.load(jfile)
+        self.conf = conf
 
         # Create the world as a dict
-        logging.info(f"Starting a new world")
+        logging.info("Starting a new world")
         self.world = {}
-        self.world["size_x"] = confjson['world'].get("size_x", None)
-        self.world["size_y"] = confjson['world'].get("size_y", None)
+        self.world["size_x"] = conf.size_x
+        self.world["size_y"] = conf.size_y
         self.world["min_x"] = 0
         self.world["min_y"] = 0
         # size_x and size_y are the length
         self.world["max_x"] = self.world["size_x"] - 1
         self.world["max_y"] = self.world["size_y"] - 1
         self.world["size"] = str(self.world["size_x"]) + 'x'+ str(self.world["size_y"])
-        self.world["reward"] = confjson['world'].get("reward", 0)
+        # With one character the world has its reward and position. With more, a list of each
+        if len(conf.characters) == 1:
+            self.world["reward"] = conf.reward
+        else:
+            self.world["rewards"] = []
         # Positions are stored as continous list, from 0 to 99 (for 100 positions example)
         self.world["positions"] = []
         # Track the end
         self.world['end'] = False
-        # Move penalty
-        self.move_penalty = -1
         # Max steps
-        self.steps = confjson['max_steps']
-
-        # Iconography
-        self.background = ' '
-
-        # Fill the positions of the world with background
-        self.world['positions'][0:9] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][10:19] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][20:29] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][30:39] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][40:49] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][50:59] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][60:69] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][70:79] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][80:89] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-        self.world['positions'][90:99] = [self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background,self.background]
-
-        # Load all objects in the world
-        self.objects = confjson['objects']
-        logging.info(f"conf obj: {confjson['objects']}")
-
-        # The character object is special, needs to be in the world for the client
-        self.world['current_character_position'] = self.objects['character']['x'] + (self.objects['character']['y'] * self.world['size_x'])
-
-        # Init objects that do need to appear in the world for the client
-        for object in self.objects:
-            # positions
-            # The objects are loaded as pos = X + (Y * X_size)
-            self.world['positions'][
-                    self.objects[object]['x']
-                    + (self.objects[object]['y']
-                        * self.world['size_x'])
-                    ] = self.objects[object]['icon']
-
-        logging.info(f"Objects: {self.objects}")
-
-        # Add the fixed objects
-        # self.put_fixed_items()
-
-    def put_fixed_items(self):
-        """
-        Add the fixed items
-        """
-        # output gate
-        for object in self.objects:
-            # positions
-            if not 'character' in object:
-                if self.objects[object]['consumable'] == False or (self.objects[object]['consumable'] == True and self.objects[object]['taken'] == False):
-                    # The objects are loaded as pos = X + (Y * X_size)
-                    self.world['positions'][
-                            self.objects[object]['x']
-                            + (self.objects[object]['y']
-                                * self.world['size_x'])
-                            ] = self.objects[object]['icon']
+        self.steps = conf.max_steps
+        # Cooldown after each key
+        self.speed = conf.speed
+
+        # The mutable state of the characters and objects
+        self.characters_x = [x for x, _, _ in conf.characters]
+        self.characters_y = [y for _, y, _ in conf.characters]
+        self.rewards = [conf.reward] * len(conf.characters)
+        self.taken = bytearray(conf.taken)
+
+        # Fill the positions of the world
+        self.draw_world()
+
+    def snapshot(self):
+        """
+        Get the mutable state of the game
+
+        Only the characters positions, the taken flags, the steps left,
+        the end flag and the last rewards change while playing, so only
+        those are stored. Everything else comes from the config.
+        """
+        return (tuple(self.characters_x),
+                tuple(self.characters_y),
+                bytes(self.taken),
+                self.steps,
+                self.world['end'],
+                tuple(self.rewards))
+
+    def restore(self, snapshot):
+        """
+        Put the game back in the state of a previous snapshot()
+        """
+        characters_x, characters_y, taken, self.steps, self.world['end'], rewards = snapshot
+        self.characters_x = list(characters_x)
+        self.characters_y = list(characters_y)
+        self.rewards = list(rewards)
+        self.taken = bytearray(taken)
+        # The keys of the last macro action are not part of the state
+        self.world.pop('action_steps', None)
+        self.world.pop('step_reward', None)
+        self.draw_world()
+
+    def clone(self):
+        """
+        Get a copy of the game that can be played without changing this one
+
+        The compiled config is shared. Only the world, the characters and the
+        taken flags are copied, and the copy has no cooldown so it can be used
+        for fast rollouts.
+        """
+        new_game = copy.copy(self)
+        new_game.world = dict(self.world)
+        new_game.world['positions'] = list(self.world['positions'])
+        new_game.characters_x = list(self.characters_x)
+        new_game.characters_y = list(self.characters_y)
+        new_game.rewards = list(self.rewards)
+        new_game.taken = bytearray(self.taken)
+        new_game.speed = 0
+        return new_game
+
+    def draw_world(self):
+        """
+        Draw all the positions of the world from the state of the objects
+        """
+        positions = [self.background] * (self.conf.size_x * self.conf.size_y)
+        for index, (x, y) in enumerate(zip(self.characters_x, self.characters_y)):
+            positions[x + (y * self.conf.size_x)] = self.conf.characters[index][2]
+        # Objects that were not taken are drawn on top of the characters
+        for index, obj in enumerate(self.conf.objects):
+            if not obj.consumable or not self.taken[index]:
+                positions[obj.position] = obj.icon
+        self.world['positions'] = positions
+        self.update_characters()
+
+    def update_characters(self):
+        """
+        Put the rewards and positions of the characters in the world
+        """
+        if len(self.rewards) == 1:
+            self.world['reward'] = self.rewards[0]
+            self.world['current_character_position'] = self.characters_x[0] + (self.characters_y[0] * self.conf.size_x)
+        else:
+            self.world['rewards'] = list(self.rewards)
+            self.world['character_positions'] = [x + (y * self.conf.size_x) for x, y in zip(self.characters_x, self.characters_y)]
+
+    def cell_icon(self, position, default):
+        """
+        Get the icon of the objects still visible in a position, or the default
+        """
+        icon = default
+        for index in self.conf.objects_at.get(position, ()):
+            obj = self.conf.objects[index]
+            if not obj.consumable or not self.taken[index]:
+                icon = obj.icon
+        return icon
 
     def get_world(self):
         """
@@ -189,33 +857,72 @@ class Game_HGW(object):
         """
         return self.world
 
-    def check_boundaries(self):
+    def memory_usage(self):
+        """
+        Get the bytes used by the state of this game
+        The compiled config is shared by all the games, so it is not counted
+        """
+        return (sys.getsizeof(self)
+                + sys.getsizeof(self.world)
+                + sys.getsizeof(self.world['positions'])
+                + sys.getsizeof(self.characters_x)
+                + sys.getsizeof(self.characters_y)
+                + sys.getsizeof(self.rewards)
+                + sys.getsizeof(self.taken))
+
+    def check_boundaries(self, index):
         """
         Check boundaries of world and character
         """
         # Check boundaries
-        if self.objects['character']['x'] >= self.world['max_x']:
-            self.objects['character']['x'] = self.world['max_x']
-        elif self.objects['character']['x'] <= self.world['min_x']:
-            self.objects['character']['x'] = self.world['min_x']
+        if self.characters_x[index] >= self.world['max_x']:
+            self.characters_x[index] = self.world['max_x']
+        elif self.characters_x[index] <= self.world['min_x']:
+            self.characters_x[index] = self.world['min_x']
 
-        if self.objects['character']['y'] >= self.world['max_y']:
-            self.objects['character']['y'] = self.world['max_y']
-        elif self.objects['character']['y'] <= self.world['min_y']:
-            self.objects['character']['y'] = self.world['min_y']
+        if self.characters_y[index] >= self.world['max_y']:
+            self.characters_y[index] = self.world['max_y']
+        elif self.characters_y[index] <= self.world['min_y']:
+            self.characters_y[index] = self.world['min_y']
 
-    def check_collisions(self):
+    def check_characters(self, old_x, old_y):
         """
-        Check goal of world and other collisions
+        Check collisions between characters
+
+        Two characters can not end in the same position, and they can not
+        swap positions. The characters that moved into a collision go back,
+        which can cause new collisions, so it is checked until none is left.
         """
-        for object in self.objects:
-            # positions
-            if not 'character' in object:
-                if self.objects[object]['consumable'] == False or (self.objects[object]['consumable'] == True and self.objects[object]['taken'] == False):
-                    if self.objects[object]['x'] == self.objects['character']['x'] and self.objects[object]['y'] == self.objects['character']['y']:
-                        self.world['reward'] = self.objects[object]['reward']
-                        self.objects[object]['taken'] = True
+        size_x = self.conf.size_x
+        old_positions = [x + (y * size_x) for x, y in zip(old_x, old_y)]
+        while True:
+            positions = [x + (y * size_x) for x, y in zip(self.characters_x, self.characters_y)]
+            blocked = set()
+            for index, position in enumerate(positions):
+                if position == old_positions[index]:
+                    continue
+                for other, other_position in enumerate(positions):
+                    if other == index:
+                        continue
+                    if position == other_position or (position == old_positions[other] and other_position == old_positions[index]):
+                        blocked.add(index)
+                        break
+            if not blocked:
+                return
+            for index in blocked:
+                self.characters_x[index] = old_x[index]
+                self.characters_y[index] = old_y[index]
 
+    def check_collisions(self, index):
+        """
+        Check goal of world and other collisions
+        """
+        position = self.characters_x[index] + (self.characters_y[index] * self.conf.size_x)
+        for object_index in self.conf.objects_at.get(position, ()):
+            obj = self.conf.objects[object_index]
+            if not obj.consumable or not self.taken[object_index]:
+                self.rewards[index] = obj.reward
+                self.taken[object_index] = True
 
     def check_end(self):
         """
@@ -224,40 +931,75 @@ class Game_HGW(object):
         Two OR conditions
         - If steps is 0 then the game ends
         - If the output gate was crossed, the game ends
+        With many characters, the game ends for all of them
         """
-        logging.info('Checking end')
+        logging.debug('Checking end')
         if self.steps <= 0:
             self.world['end'] = True
             logging.info('World end by timoutout')
             return True
-        for obj in self.objects:
-            try:
-                if self.objects[obj]['ends_game'] == True:
-                    if self.objects[obj]['taken'] == True:
-                        logging.info(f'World end by gate: {obj}')
-                        self.world['end'] = True
-                        return True
-            except KeyError:
-                # Some objects dont have the key 'ends_game'
-                pass
+        for index in self.conf.ends_game:
+            if self.taken[index]:
+                logging.info('World end by gate: %s', self.conf.objects[index].name)
+                self.world['end'] = True
+                return True
         return False
 
-    def check_walls(self, x, y):
+    def check_walls(self, index, x, y):
         """
         Check if the object in the position character+x, character+y is solid or not
         """
-        proposed_x = self.objects['character']['x'] + x
-        proposed_y = self.objects['character']['y'] + y
-        for object in self.objects:
-            if not 'character' in object:
-                if self.objects[object]['x'] == proposed_x and self.objects[object]['y'] == proposed_y and self.objects[object]['solid'] == True:
-                    return True
-        return False
+        proposed_x = self.characters_x[index] + x
+        proposed_y = self.characters_y[index] + y
+        # Outside of the grid there are no walls, the boundaries are checked later
+        if proposed_x < 0 or proposed_x >= self.conf.size_x or proposed_y < 0 or proposed_y >= self.conf.size_y:
+            return False
+        return proposed_x + (proposed_y * self.conf.size_x) in self.conf.walls
 
     def process_input_key(self, key):
         """
         process input key
         """
+        self.process_input_keys((key,))
+
+    def process_input_macro(self, message):
+        """
+        process a macro action: keys separated by spaces, where each key can
+        be repeated as KEY*N, such as UP*4 or UP*2 RIGHT*3
+        The keys are played until the game ends or an object gives a reward
+        The reward is the sum of the rewards of the steps played, the steps
+        played are sent in 'action_steps' and the reward of the last step,
+        the one that stopped the macro, in 'step_reward'
+        """
+        self.world.pop('action_steps', None)
+        self.world.pop('step_reward', None)
+        keys = []
+        for token in message.split() or [message]:
+            key, _, repeat = token.partition('*')
+            # A key is played at least once
+            repeat = min(max(int(repeat), 1), self.max_action_repeat) if repeat.isdecimal() else 1
+            keys.extend([key] * repeat)
+        if len(keys) == 1:
+            self.process_input_key(keys[0])
+            return
+        reward = 0
+        steps = 0
+        for key in keys[:self.max_action_repeat]:
+            self.process_input_key(key)
+            reward += self.rewards[0]
+            steps += 1
+            if self.world['end'] or self.rewards[0] != self.move_penalty:
+                break
+        self.world['step_reward'] = self.rewards[0]
+        self.rewards[0] = reward
+        self.world['action_steps'] = steps
+        self.update_characters()
+
+    def process_input_keys(self, keys):
+        """
+        process one input key for each character, all in the same step
+        Characters without a key do not move
+        """
         # The world positions is a 100-values vector (in 100 states)
         # X (horizontal in the grid) goes from 0 to 9 to the right, Y (vertical in the grid) goes from 0 to 9 down
         # The top-left corner is X=0, Y=0
@@ -274,52 +1016,56 @@ class Game_HGW(object):
         #  X=3, Y=1 -> pos=13
         #  X=0, Y=9 -> pos=90
 
-        # Find the new positions of the character
-        # Delete the current character
-        self.world['positions'][self.objects['character']['x'] + (self.objects['character']['y'] * self.world['size_x'])] = self.background
-        if "UP" in key:
+        # Find the new positions of the characters
+        old_x = list(self.characters_x)
+        old_y = list(self.characters_y)
+        for index, key in enumerate(keys[:len(self.characters_x)]):
+            if "UP" in key:
+                # Check that the boundaries of the game were not violated
+                if not self.check_walls(index, 0, -1):
+                    self.characters_y[index] -= 1
+            elif "DOWN" in key:
+                if not self.check_walls(index, 0, 1):
+                    self.characters_y[index] += 1
+            elif "RIGHT" in key:
+                if not self.check_walls(index, 1, 0):
+                    self.characters_x[index] += 1
+            elif "LEFT" in key:
+                if not self.check_walls(index, -1, 0):
+                    self.characters_x[index] -= 1
+
             # Check that the boundaries of the game were not violated
-            if not self.check_walls(0, -1):
-                self.objects['character']['y'] -= 1
-        elif "DOWN" in key:
-            if not self.check_walls(0, 1):
-                self.objects['character']['y'] += 1
-        elif "RIGHT" in key:
-            if not self.check_walls(1, 0):
-                self.objects['character']['x'] += 1
-        elif "LEFT" in key:
-            if not self.check_walls(-1, 0):
-                self.objects['character']['x'] -= 1
-        logging.info(f"The char was moved to {self.objects['character']['x']} {self.objects['character']['y']} ")
+            self.check_boundaries(index)
+            logging.debug('The char %s was moved to %s %s', index, self.characters_x[index], self.characters_y[index])
+
+        # Check that the characters did not collide between them
+        if len(self.characters_x) > 1:
+            self.check_characters(old_x, old_y)
 
         # Compute the character move penalty in reward
-        self.world['reward'] = self.move_penalty
+        self.rewards = [self.move_penalty] * len(self.characters_x)
         # Decrease one step
         self.steps -= 1
 
-        # Check that the boundaries of the game were not violated
-        self.check_boundaries()
-
         # Check if there were any collisions
-        self.check_collisions()
+        for index in range(len(self.characters_x)):
+            self.check_collisions(index)
 
         # Check if the game ended
         self.check_end()
 
-        # Move the character
-        self.world['positions'][self.objects['character']['x'] + (self.objects['character']['y'] * self.world['size_x'])] = self.objects['character']['icon']
-        self.world['current_character_position'] = self.objects['character']['x'] + (self.objects['character']['y'] * self.world['size_x'])
+        # Move the characters
+        # Only the old and new positions change. Objects not taken stay on top of the characters
+        size_x = self.conf.size_x
+        for x, y in zip(old_x, old_y):
+            position = x + (y * size_x)
+            self.world['positions'][position] = self.cell_icon(position, self.background)
+        for index, (x, y) in enumerate(zip(self.characters_x, self.characters_y)):
+            position = x + (y * size_x)
+            self.world['positions'][position] = self.cell_icon(position, self.conf.characters[index][2])
+        self.update_characters()
 
-        # Put fixed objects back
-        self.put_fixed_items()
-
-        logging.info(f"Score after key: {self.world['reward']}")
-
-        # Cooldown period
-        # Each key inputted is forced to wait a little
-        # This should be at least 0.1 for human play or replay mode
-        # Should be 0 for agents to play
-        time.sleep(confjson.get('speed', 0))
+        logging.debug('Score after key: %s', self.rewards)
 
 
 # Main
@@ -329,18 +1075,49 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description=f"Hacker Grid World Server version {__version__}. Author: Sebastian Garcia, eldraco@gmail.com", usage='%(prog)s -n <screen_name> [options]')
     parser.add_argument('-v', '--verbose', help='Verbosity level. This shows more info about the results.', action='store', required=False, type=int)
-    parser.add_argument('-d', '--debug', help='Debugging level. This shows inner information about the flows.', action='store', required=False, type=int)
-    parser.add_argument('-c', '--configfile', help='Configuration file.', action='store', required=True, type=str)
-    parser.add_argument('-t', '--test', help='Run serve in test mode. Speed is 0.1 and port is the port in the conf + 1', action='store_true', required=False)
+    parser.add_argument('-d', '--debug', help='Debugging level. This shows inner information about the flows. A level of the logging module, such as 20 for INFO or 10 for DEBUG.', action='store', required=False, type=int)
+    parser.add_argument('-c', '--configfile', help='Configuration files. The settings of the server come from the first one. Each one is a world that the clients can choose by name.', action='store', required=True, type=str, nargs='+')
+    parser.add_argument('-t', '--test', help='Run serve in test mode. Speed is 0.1, port is the port in the conf + 1 and the unix socket ends in .test', action='store_true', required=False)
 
     args = parser.parse_args()
-    logging.basicConfig(filename='server.log', filemode='a', format='%(asctime)s, %(name)s: %(message)s', datefmt='%H:%M:%S', level=logging.CRITICAL)
+    # The file is written by a thread, so logging does not block the sessions
+    setup_logging('server.log', level=args.debug or logging.CRITICAL)
 
-    with open(args.configfile, 'r') as jfile:
-        confjson = json.load(jfile)
-        if args.test:
-            confjson['speed'] = 0.1
-            confjson['port'] = confjson['port'] + 1
+    confjson = read_configfile(args.configfile[0])
+    if args.test:
+        confjson['port'] = confjson['port'] + 1
+        if confjson.get('spectator_port', None):
+            confjson['spectator_port'] = confjson['spectator_port'] + 1
+        if confjson.get('unix_socket', None):
+            confjson['unix_socket'] = confjson['unix_socket'] + '.test'
+
+    # Sessions being played, by id
+    sessions = {}
+    session_ids = itertools.count(1)
+    # Bytes that can wait to be sent to a spectator before its worlds are dropped
+    spectator_buffer = confjson.get('spectator_buffer', 65536)
+    # Limits of the sessions. None means no limit
+    max_sessions = confjson.get('max_sessions', None)
+    idle_timeout = confjson.get('idle_timeout', None)
+    step_timeout = confjson.get('step_timeout', None)
+    server_stats = {'rejected': 0, 'reaped': 0}
+    # Trace 1 in trace_sessions sessions, and 1 in trace_steps steps of those. 0 traces nothing
+    trace_sessions = confjson.get('trace_sessions', 1)
+    trace_steps = confjson.get('trace_steps', 1)
+    # In worlds with many characters, one client can play all of them
+    batched_agents = confjson.get('batched_agents', False)
+    # Send the first world of the next game inside the last world of a game
+    auto_reset = confjson.get('auto_reset', False)
+    # Seconds a shared world waits for the keys of its clients before stepping without them. 0 waits forever
+    shared_step_timeout = confjson.get('shared_step_timeout', 10)
+    # Compile the worlds once, all the games share them. The first one is the default
+    worlds = {}
+    for configfile in args.configfile:
+        hosted = Hosted_World(configfile, confjson if configfile == args.configfile[0] else read_configfile(configfile))
+        if hosted.name in worlds:
+            parser.error(f'The configs {worlds[hosted.name].configfile} and {configfile} are both the world {hosted.name}. Give one of them another name with the key "name" in its config')
+        worlds[hosted.name] = hosted
+    default_world = next(iter(worlds))
 
     try:
         logging.debug('Server start')
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Training telemetry for the agents of the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import argparse
+import atexit
+import json
+import os
+import numpy as np
+
+__version__ = 'v0.1'
+
+# Columns of each row, one per episode, and how they are stored
+columns = (
+    ('episode', '<i8'),
+    ('score', '<f8'),
+    ('steps', '<i8'),
+    ('epsilon', '<f8'),
+    ('levels', '<i8'),
+    # Unix time when the episode ended
+    ('wall_time', '<f8'),
+    ('steps_per_sec', '<f8'),
+    ('eval', '|u1'),
+)
+
+
+class Telemetry_Writer(object):
+    """
+    Class Telemetry_Writer
+    Appends one row per episode to the files of a run
+
+    Each column is a binary file in the run directory, so a row is only a
+    few bytes and a whole column is loaded at once. The rows are kept in
+    memory and written every flush_every rows, and when the program ends.
+    """
+    def __init__(self, run_dir, flush_every=100):
+        self.run_dir = run_dir
+        self.flush_every = flush_every
+        self.rows = {name: [] for name, _ in columns}
+        self.pending = 0
+        os.makedirs(run_dir, exist_ok=True)
+        # Describe the columns so the run can be read without this code
+        with open(os.path.join(run_dir, 'columns.json'), 'w') as jfile:
+            json.dump(dict(columns), jfile)
+        atexit.register(self.flush)
+
+    def append(self, **row):
+        """
+        Add a row. The keys are the names of the columns
+        """
+        for name, _ in columns:
+            self.rows[name].append(row[name])
+        self.pending += 1
+        if self.pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the rows in memory to the column files
+        """
+        if not self.pending:
+            return
+        for name, dtype in columns:
+            with open(os.path.join(self.run_dir, name + '.bin'), 'ab') as bfile:
+                np.asarray(self.rows[name], dtype=dtype).tofile(bfile)
+            self.rows[name] = []
+        self.pending = 0
+
+
+def load_run(run_dir):
+    """
+    Load all the rows of a run as a dict of arrays, one per column
+    """
+    with open(os.path.join(run_dir, 'columns.json'), 'r') as jfile:
+        run_columns = json.load(jfile)
+    run = {}
+    for name, dtype in run_columns.items():
+        run[name] = np.fromfile(os.path.join(run_dir, name + '.bin'), dtype=dtype)
+    # If the program was killed while writing, ignore the last incomplete row
+    rows = min(len(values) for values in run.values())
+    return {name: values[:rows] for name, values in run.items()}
+
+
+# Main
+####################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Hacker Grid World telemetry reader version {__version__}. Author: Sebastian Garcia, eldraco@gmail.com", usage='%(prog)s <run_dir> [<run_dir> ...]')
+    parser.add_argument('run_dirs', help='Directories of the runs to summarize.', nargs='+', type=str)
+
+    args = parser.parse_args()
+
+    for run_dir in args.run_dirs:
+        run = load_run(run_dir)
+        episodes = len(run['episode'])
+        if not episodes:
+            print(f'{run_dir}: no episodes')
+            continue
+        training = run['eval'] == 0
+        elapsed = run['wall_time'][-1] - run['wall_time'][0]
+        print(f"{run_dir}: {episodes} episodes in {elapsed:.1f}s. "
+              f"Steps: {run['steps'].sum()}. "
+              f"Steps/sec: {run['steps'].sum() / elapsed if elapsed else 0:.1f}. "
+              f"Avg training score: {run['score'][training].mean() if training.any() else 0:.2f}. "
+              f"Last eval score: {run['score'][~training][-1] if (~training).any() else None}. "
+              f"Levels: {run['levels'][-1]}")
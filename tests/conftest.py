@@ -0,0 +1,5 @@
+# The modules of the Hacker Grid World are scripts in the top directory
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
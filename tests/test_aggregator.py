@@ -0,0 +1,95 @@
+# Tests of the q_table aggregator of the Hacker Grid World Reinforcement Learning
+# The aggregator runs as a local process, and the workers are Aggregator_Client
+
+import os
+import socket
+import subprocess
+import sys
+import time
+import pytest
+from aggregator import Aggregator_Client
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(params=['visits', 'average'])
+def aggregator_address(request, tmp_path):
+    """
+    Start an aggregator in a free port of localhost, with one of the merge modes
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen([sys.executable, os.path.join(repo_dir, 'aggregator.py'), '-s', '127.0.0.1', '-p', str(port),
+                                '-m', request.param, '-o', str(tmp_path / 'merged-model'), '-e', '0'], cwd=tmp_path)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield request.param, f'127.0.0.1:{port}'
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def sync(client, changes):
+    """
+    Sync the changes of a q_table of 10 states and 4 actions. Returns the merged levels received
+    """
+    return dict(client.sync(10, 4, changes))
+
+
+def test_merge_two_workers(aggregator_address):
+    merge, address = aggregator_address
+    worker_a = Aggregator_Client(address, worker='a', timeout=5)
+    worker_b = Aggregator_Client(address, worker='b', timeout=5)
+
+    merged = sync(worker_a, {'GF': {(0, 0): [10, 1]}})
+    assert merged['GF'][0, 0] == 10
+    merged = sync(worker_b, {'GF': {(0, 0): [20, 3]}})
+    expected = 17.5 if merge == 'visits' else 15
+    assert merged['GF'][0, 0] == pytest.approx(expected)
+    assert merged['GF'].shape == (10, 4)
+
+    # Syncs without changes do not change the merged q_table, and receive nothing
+    for _ in range(5):
+        assert sync(worker_b, {}) == {}
+    # The other worker gets the level that changed since its last sync once
+    merged = sync(worker_a, {})
+    assert merged['GF'][0, 0] == pytest.approx(expected)
+    assert sync(worker_a, {}) == {}
+
+
+def test_merge_levels_of_other_workers(aggregator_address):
+    merge, address = aggregator_address
+    worker_a = Aggregator_Client(address, worker='a', timeout=5)
+    worker_b = Aggregator_Client(address, worker='b', timeout=5)
+
+    sync(worker_a, {90: {(5, 1): [4, 2]}})
+    # The worker gets a level it never played, and changes it starting from the merged values
+    merged = sync(worker_b, {})
+    assert merged[90][5, 1] == 4
+    merged = sync(worker_b, {90: {(5, 1): [2, 2], (6, 0): [-1, 1]}})
+    if merge == 'visits':
+        assert merged[90][5, 1] == pytest.approx((4 * 2 + 6 * 2) / 4)
+        assert merged[90][6, 0] == pytest.approx(-1)
+    else:
+        assert merged[90][5, 1] == pytest.approx(5)
+        assert merged[90][6, 0] == pytest.approx(-0.5)
+
+
+def test_sync_timeout():
+    # An aggregator that accepts the connection but never answers
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        client = Aggregator_Client(f'127.0.0.1:{listener.getsockname()[1]}', timeout=0.5)
+        with pytest.raises(OSError):
+            sync(client, {'GF': {(0, 0): [1, 1]}})
+        assert client.sock is None
@@ -0,0 +1,45 @@
+# Tests of the sparse q_table of the Hacker Grid World Reinforcement Learning
+
+import numpy as np
+from qtable import Sparse_QTable
+
+
+def fill(q_table, levels):
+    """
+    Create the levels with some values in states of different blocks
+    """
+    for number, level in enumerate(levels):
+        q_table.create_level(level)
+        for state in range(0, q_table.n_states, 7):
+            q_table[level][state][state % q_table.n_actions] = state + number
+
+
+def test_save_without_budget(tmp_path):
+    q_table = Sparse_QTable(100, 4, block_size=8)
+    fill(q_table, ['GF', 70, 81])
+    q_table.save(str(tmp_path / 'model'))
+    saved = np.load(tmp_path / 'model.npy', allow_pickle=True).item()
+    expected = q_table.to_dict()
+    assert type(saved) is dict
+    assert list(saved) == ['GF', 70, 81]
+    assert all(np.array_equal(saved[level], expected[level]) for level in expected)
+
+
+def test_save_with_spilled_levels(tmp_path):
+    # A budget of one block, so all the levels but the last one used are spilled
+    q_table = Sparse_QTable(100, 4, block_size=8, memory_budget=8 * 4 * 8, spill_dir=str(tmp_path / 'spill'))
+    fill(q_table, ['GF', 70, 81, 92])
+    assert len(q_table.spilled) == 3
+    expected = q_table.to_dict()
+    q_table.save(str(tmp_path / 'model'))
+    q_table.save_txt(str(tmp_path / 'model.txt'))
+    saved = np.load(tmp_path / 'model.npy', allow_pickle=True).item()
+    assert type(saved) is dict
+    # The levels keep the order they were created in, spilled or not
+    assert list(saved) == ['GF', 70, 81, 92]
+    assert all(np.array_equal(saved[level], expected[level]) for level in expected)
+    assert (tmp_path / 'model.txt').read_text() == str(expected)
+    # Saving does not load the spilled levels back
+    assert len(q_table.spilled) == 3
+    q_table.remove_spilled()
+    assert not (tmp_path / 'spill').exists() or not any((tmp_path / 'spill').iterdir())
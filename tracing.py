@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Logging and sampled tracing for the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import atexit
+import logging
+import logging.handlers
+import queue
+
+
+class Sampled_Tracer(object):
+    """
+    Class Sampled_Tracer
+    Logs the messages of 1 in every `every` steps
+
+    Between steps only a counter changes. The messages of the steps not
+    sampled, or for a logger that is disabled, are never formatted, so the
+    arguments should be passed apart from the message, as in logging.
+    With every 0 nothing is logged.
+    """
+    __slots__ = ('every', 'level', 'steps', 'sampled')
+
+    def __init__(self, every=1, level=logging.INFO):
+        self.every = every
+        self.level = level
+        self.steps = 0
+        self.sampled = False
+
+    def step(self):
+        """
+        Start a new step. Returns True if its messages are logged
+        """
+        self.steps += 1
+        self.sampled = bool(self.every) and self.steps % self.every == 0
+        return self.sampled
+
+    def log(self, logger, msg, *args):
+        """
+        Log a message in the logger, if this step is sampled
+        """
+        if self.sampled and logger.isEnabledFor(self.level):
+            logger.log(self.level, msg, *args)
+
+
+def setup_logging(filename, level=logging.CRITICAL, format='%(asctime)s, %(name)s: %(message)s', datefmt='%H:%M:%S'):
+    """
+    Log to a file without blocking the caller
+
+    The records go to a queue, and a thread writes them to the file. The
+    message is still formatted by the caller, so later changes to the
+    arguments, such as the q_table, do not change what is logged.
+    """
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(filename, mode='a')
+    file_handler.setFormatter(logging.Formatter(format, datefmt))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    # Write the records left in the queue when the program ends
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Procedural world generator for the Hacker Grid World Reinforcement Learning
+# Author: sebastian garcia, eldraco@gmail.com.
+
+import argparse
+import logging
+import json
+import random
+import time
+
+__version__ = 'v0.1'
+
+# Default parameters of the generated worlds
+default_params = {
+    'size_x': 10,
+    'size_y': 10,
+    'wall_density': 0.2,
+    'goals': 2,
+    'gates': 1,
+    'goal_reward_min': 10,
+    'goal_reward_max': 1000,
+    'gate_reward': 100,
+    'max_steps': 500,
+    'speed': 0,
+    'max_attempts': 100,
+}
+
+
+def flood_fill(start_mask, free_mask, size_x, size_y):
+    """
+    Get the mask of all the positions reachable from start_mask
+
+    The grid is stored as the bits of an int, bit = X + (Y * X_size),
+    so each shift moves every cell of the grid at the same time
+    """
+    full_mask = (1 << (size_x * size_y)) - 1
+    # Rows are contiguous, so moving right or left must not wrap to the next row
+    first_column = 0
+    for y in range(size_y):
+        first_column |= 1 << (y * size_x)
+    not_first_column = full_mask & ~first_column
+    not_last_column = full_mask & ~(first_column << (size_x - 1))
+
+    reached = start_mask & free_mask
+    while True:
+        grown = (reached
+                 | ((reached << 1) & not_first_column)
+                 | ((reached >> 1) & not_last_column)
+                 | (reached << size_x)
+                 | (reached >> size_x)) & free_mask
+        if grown == reached:
+            return reached
+        reached = grown
+
+
+def generate_world(seed, **params):
+    """
+    Generate a random valid world from a seed
+
+    Returns a config dict in the same format as the server config files.
+    The same seed and parameters always give the same world. All goals and
+    gates are reachable from the character.
+    """
+    conf = dict(default_params)
+    conf.update(params)
+    size_x = conf['size_x']
+    size_y = conf['size_y']
+    cells = size_x * size_y
+    n_walls = int(round(conf['wall_density'] * cells))
+    n_targets = conf['goals'] + conf['gates']
+    if n_walls + n_targets + 1 > cells:
+        raise ValueError(f'World of {size_x}x{size_y} is too small for {n_walls} walls and {n_targets} goals and gates')
+
+    rng = random.Random(seed)
+    for attempt in range(conf['max_attempts']):
+        # Take all the positions at once so no object shares a cell
+        positions = rng.sample(range(cells), n_walls + n_targets + 1)
+        walls = positions[:n_walls]
+        character = positions[n_walls]
+        targets = positions[n_walls + 1:]
+
+        wall_mask = 0
+        for position in walls:
+            wall_mask |= 1 << position
+        target_mask = 0
+        for position in targets:
+            target_mask |= 1 << position
+        free_mask = ((1 << cells) - 1) & ~wall_mask
+
+        reached = flood_fill(1 << character, free_mask, size_x, size_y)
+        if reached & target_mask == target_mask:
+            break
+    else:
+        raise ValueError(f'No valid world found for seed {seed} after {conf["max_attempts"]} attempts')
+
+    objects = {}
+    objects['character'] = {'x': character % size_x, 'y': character // size_x, 'icon': 'W'}
+    for index, position in enumerate(targets[conf['gates']:]):
+        objects[f'goal{index + 1}'] = {
+            'x': position % size_x,
+            'y': position // size_x,
+            'reward': rng.randint(conf['goal_reward_min'], conf['goal_reward_max']),
+            'icon': str((index + 1) % 10),
+            'taken': False,
+            'ends_game': False,
+            'consumable': True,
+            'solid': False}
+    for index, position in enumerate(targets[:conf['gates']]):
+        objects[f'output_gate{index + 1}'] = {
+            'x': position % size_x,
+            'y': position // size_x,
+            'reward': conf['gate_reward'],
+            'icon': 'O',
+            'taken': False,
+            'ends_game': True,
+            'consumable': False,
+            'solid': False}
+    for index, position in enumerate(walls):
+        objects[f'wall{index + 1}'] = {
+            'x': position % size_x,
+            'y': position // size_x,
+            'reward': 0,
+            'icon': 'X',
+            'taken': False,
+            'ends_game': False,
+            'consumable': False,
+            'solid': True}
+
+    return {
+        'world': {'size_x': size_x, 'size_y': size_y},
+        'seed': seed,
+        'max_steps': conf['max_steps'],
+        'speed': conf['speed'],
+        'objects': objects}
+
+
+# Main
+####################
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=f"Hacker Grid World procedural world generator version {__version__}. Author: Sebastian Garcia, eldraco@gmail.com", usage='%(prog)s -s <seed> [options]')
+    parser.add_argument('-s', '--seed', help='Seed of the first world.', action='store', required=False, type=int, default=0)
+    parser.add_argument('-n', '--number', help='Amount of worlds to generate. Prints how many worlds per second were generated.', action='store', required=False, type=int, default=1)
+    parser.add_argument('-p', '--params', help='JSON dict with the parameters of the worlds, such as {"size_x": 20, "wall_density": 0.3}.', action='store', required=False, type=str, default='{}')
+    parser.add_argument('-c', '--configfile', help='Server config file to take the host, port and speed from.', action='store', required=False, type=str)
+    parser.add_argument('-o', '--output', help='Write the world of the first seed as a server config file.', action='store', required=False, type=str)
+
+    args = parser.parse_args()
+    logging.basicConfig(filename='world_generator.log', filemode='a', format='%(asctime)s, %(name)s: %(message)s', datefmt='%H:%M:%S', level=logging.CRITICAL)
+
+    params = json.loads(args.params)
+    if args.configfile:
+        with open(args.configfile, 'r') as jfile:
+            confjson = json.load(jfile)
+        # The world replaces the one of the config
+        confjson.pop('generator', None)
+        params.setdefault('speed', confjson.get('speed', 0))
+    else:
+        confjson = {'host': '127.0.0.1', 'port': 9000}
+
+    start_time = time.time()
+    for seed in range(args.seed, args.seed + args.number):
+        world = generate_world(seed, **params)
+        if seed == args.seed:
+            first_world = world
+    elapsed = time.time() - start_time
+    print(f'Generated {args.number} worlds in {elapsed:.3f}s ({args.number / max(elapsed, 1e-9):.0f} worlds/s)')
+
+    if args.output:
+        confjson.update(first_world)
+        with open(args.output, 'w') as jfile:
+            json.dump(confjson, jfile, indent=4)